@@ -0,0 +1,84 @@
+"""
+Guards the startup latency of `import kura` and the `kura` CLI.
+
+Each import is timed in a fresh interpreter and we fail if the median time goes over the budget or if any heavy dependency is imported eagerly.
+
+    python benchmarks/import_time.py --max-seconds 1.0
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# These are only needed once we actually call a model or cluster, they must never be loaded at import time
+HEAVY_MODULES = [
+    "umap",
+    "numba",
+    "sklearn",
+    "hdbscan",
+    "openai",
+    "instructor",
+    "google.generativeai",
+    "vertexai",
+    "fastapi",
+    "uvicorn",
+    "pandas",
+]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def time_import(module: str) -> tuple[float, list[str]]:
+    # Credentials should not be needed to import anything
+    env = {"PATH": "", "PYTHONDONTWRITEBYTECODE": "1"}
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return result["elapsed"], result["loaded"]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=1.0)
+    parser.add_argument(
+        "--modules", nargs="+", default=["kura", "kura.cli.cli", "kura.types"]
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        timings = []
+        loaded: list[str] = []
+        for _ in range(args.runs):
+            elapsed, loaded = time_import(module)
+            timings.append(elapsed)
+
+        median = statistics.median(timings)
+        status = "ok"
+        if median > args.max_seconds:
+            status = f"too slow (budget {args.max_seconds:.2f}s)"
+            failed = True
+        if loaded:
+            status = f"eagerly imports {', '.join(loaded)}"
+            failed = True
+        print(f"import {module:<15} median {median * 1000:7.1f}ms  {status}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
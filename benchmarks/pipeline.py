@@ -0,0 +1,156 @@
+"""
+Runs the full Kura pipeline against the offline stand-ins in `kura.testing` and reports wall time, throughput and peak memory for every stage.
+
+    python benchmarks/pipeline.py --sizes 1000 10000 100000 --latency 0.05 --error-rate 0.01
+
+Use `--output` to write the results as JSON so runs can be compared to catch regressions.
+"""
+
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+from kura import Kura
+from kura.cluster import ClusterModel
+from kura.dimensionality import HDBUMAP
+from kura.meta_cluster import MetaClusterModel
+from kura.summarisation import SummaryModel
+from kura.testing import (
+    FakeEmbeddingModel,
+    FakeInstructorClient,
+    LatencySimulator,
+    generate_conversations,
+)
+
+
+@contextmanager
+def measure(results: list[dict[str, Any]], stage: str, items: int) -> Iterator[None]:
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    results.append(
+        {
+            "stage": stage,
+            "items": items,
+            "wall_time_s": round(elapsed, 3),
+            "throughput_per_s": round(items / elapsed, 1) if elapsed else None,
+            "peak_memory_mb": round(peak / 1024 / 1024, 1) if peak else None,
+        }
+    )
+
+
+def build_kura(args: argparse.Namespace, checkpoint_dir: str) -> Kura:
+    def latency(seed: int) -> LatencySimulator:
+        return LatencySimulator(
+            latency_mean=args.latency,
+            latency_sigma=args.latency_sigma,
+            error_rate=args.error_rate,
+            seed=seed,
+        )
+
+    embedding_model = FakeEmbeddingModel(latency=latency(1))
+    meta_cluster_model = MetaClusterModel(
+        client=FakeInstructorClient(latency(2)),
+        embedding_model=embedding_model,
+        max_concurrent_requests=args.concurrency,
+    )
+    return Kura(
+        embedding_model=embedding_model,
+        summarisation_model=SummaryModel(
+            client=FakeInstructorClient(latency(3)),
+            max_concurrent_requests=args.concurrency,
+        ),
+        cluster_model=ClusterModel(
+            client=FakeInstructorClient(latency(4)),
+            embedding_model=embedding_model,
+            max_concurrent_requests=args.concurrency,
+        ),
+        meta_cluster_model=meta_cluster_model,
+        dimensionality_reduction=HDBUMAP(
+            embedding_model=embedding_model,
+            cluster_embeddings=meta_cluster_model.cluster_embeddings,
+        ),
+        max_clusters=args.max_clusters,
+        checkpoint_dir=checkpoint_dir,
+    )
+
+
+async def run(args: argparse.Namespace, size: int) -> list[dict[str, Any]]:
+    results: list[dict[str, Any]] = []
+    conversations = generate_conversations(size, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        kura = build_kura(args, checkpoint_dir)
+
+        with measure(results, "summarise", len(conversations)):
+            summaries = await kura.summarise_conversations(conversations)
+        with measure(results, "base_clusters", len(summaries)):
+            clusters = await kura.generate_base_clusters(summaries)
+        with measure(results, "meta_clusters", len(clusters)):
+            meta_clusters = await kura.reduce_clusters(clusters)
+        with measure(results, "dimensionality", len(meta_clusters)):
+            await kura.reduce_dimensionality(meta_clusters)
+
+    total = sum(result["wall_time_s"] for result in results)
+    results.append(
+        {
+            "stage": "total",
+            "items": size,
+            "wall_time_s": round(total, 3),
+            "throughput_per_s": round(size / total, 1) if total else None,
+            "peak_memory_mb": max(
+                (r["peak_memory_mb"] for r in results if r["peak_memory_mb"]),
+                default=None,
+            ),
+        }
+    )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean request latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--max-clusters", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-tracemalloc",
+        action="store_true",
+        help="Skip peak memory tracking, which slows down large runs",
+    )
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    report = {}
+    for size in args.sizes:
+        results = asyncio.run(run(args, size))
+        report[size] = results
+
+        print(f"\n{size} conversations")
+        print(f"{'stage':<16}{'items':>10}{'wall (s)':>12}{'items/s':>12}{'peak MB':>10}")
+        for r in results:
+            print(
+                f"{r['stage']:<16}{r['items']:>10}{r['wall_time_s']:>12}{r['throughput_per_s'] or '-':>12}{r['peak_memory_mb'] or '-':>10}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+from abc import ABC, abstractmethod
+from typing import Any, TypeVar
+
+from pydantic import BaseModel
+
+T = TypeVar("T", bound=BaseModel)
+
+
+class BaseCheckpointWriter(ABC):
+    @abstractmethod
+    def write(self, item: BaseModel) -> None:
+        """
+        Append a single item to the checkpoint, items only need to be durable once `close` returns
+        """
+        pass
+
+    @abstractmethod
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "BaseCheckpointWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class BaseCheckpointManager(ABC):
+    def path(self, checkpoint_path: str) -> str:
+        """
+        The location on disk that this backend uses for a checkpoint, backends can swap the extension to match their format
+        """
+        return checkpoint_path
+
+    @abstractmethod
+    def exists(self, checkpoint_path: str) -> bool:
+        pass
+
+    @abstractmethod
+    def load(self, checkpoint_path: str, response_model: type[T]) -> list[T]:
+        pass
+
+    @abstractmethod
+    def load_columns(
+        self, checkpoint_path: str, columns: list[str]
+    ) -> dict[str, Any]:
+        """
+        Load only the given fields of a checkpoint as a mapping of column name to values without building the pydantic models
+        """
+        pass
+
+    @abstractmethod
+    def save(self, checkpoint_path: str, items: list[BaseModel]) -> None:
+        pass
+
+    @abstractmethod
+    def open_writer(self, checkpoint_path: str) -> BaseCheckpointWriter:
+        """
+        Open a checkpoint so that we can append items to it as they complete
+        """
+        pass
+
@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
 from typing import TypeVar, Union
 
+import numpy as np
+from numpy.typing import NDArray
+
 T = TypeVar("T")
 
 
@@ -10,3 +13,18 @@ class BaseClusteringMethod(ABC):
         self, items: list[dict[str, Union[T, list[float]]]]
     ) -> dict[int, list[T]]:
         pass
+
+    def cluster_embeddings(
+        self, embeddings: NDArray[np.float32], items: list[T]
+    ) -> dict[int, list[T]]:
+        """
+        Cluster `items` using the matching rows of an (n, dim) embedding matrix.
+
+        Methods that can work on the matrix directly should override this so that large embedding sets ( eg. a memory mapped `EmbeddingStore` ) don't get converted back into Python lists.
+        """
+        return self.cluster(
+            [
+                {"item": item, "embedding": embedding}
+                for item, embedding in zip(items, embeddings.tolist())
+            ]
+        )
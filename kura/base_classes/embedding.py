@@ -1,5 +1,8 @@
 from abc import ABC, abstractmethod
 from asyncio import Semaphore
+from typing import Optional
+
+from tqdm.asyncio import tqdm_asyncio
 
 
 class BaseEmbeddingModel(ABC):
@@ -7,3 +10,18 @@ class BaseEmbeddingModel(ABC):
     async def embed(self, text: str, sem: Semaphore) -> list[float]:
         """Embed a single text into a list of floats"""
         pass
+
+    async def embed_batch(
+        self, texts: list[str], sem: Semaphore, desc: Optional[str] = None
+    ) -> list[list[float]]:
+        """Embed a list of texts, returning embeddings in the same order as the texts.
+
+        Implementations that can send several texts in a single request should override this, by default we fall back to one `embed` call per text. When `desc` is set we show a progress bar with that description.
+        """
+        return list(
+            await tqdm_asyncio.gather(
+                *[self.embed(text, sem) for text in texts],
+                desc=desc,
+                disable=desc is None,
+            )
+        )
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from typing import AsyncIterator, Iterable
 
 from kura.types import Conversation, ConversationSummary
 
@@ -11,6 +12,16 @@ class BaseSummaryModel(ABC):
         """Summarise the conversations into a list of ConversationSummary"""
         pass
 
+    async def summarise_stream(
+        self, conversations: Iterable[Conversation]
+    ) -> AsyncIterator[ConversationSummary]:
+        """Yield summaries as they are generated so that downstream stages can start consuming them early.
+
+        By default this waits for `summarise` to finish, implementations should override it to yield results as they complete.
+        """
+        for summary in await self.summarise(list(conversations)):
+            yield summary
+
     @abstractmethod
     async def summarise_conversation(
         self, conversation: Conversation
@@ -18,6 +29,12 @@ class BaseSummaryModel(ABC):
         """Summarise a single conversation into a single string"""
         pass
 
+    def conversation_metadata(self, conversation: Conversation) -> dict:
+        """
+        The metadata that describes the conversation itself rather than its summary, we recompute it for conversations that share a summary with a duplicate
+        """
+        return {"conversation_turns": len(conversation.messages)}
+
     @abstractmethod
     async def apply_hooks(
         self, conversation: ConversationSummary
@@ -1,21 +1,10 @@
 from pathlib import Path
-from kura.base_classes import BaseSummaryModel
+from kura.clients import get_instructor_openai_client
 from kura.types import Conversation, ConversationSummary
 from kura.types.summarisation import GeneratedSummary
-from asyncio import Semaphore
-from tqdm.asyncio import tqdm_asyncio
-# import google.generativeai as genai
-import instructor
-import vertexai
-import os
-from dotenv import load_dotenv, find_dotenv
-from openai import AsyncOpenAI
 import asyncio
 from tqdm.auto import tqdm
 
-load_dotenv(find_dotenv())
-vertexai.init()
-
 
 def dump_summary_to_jsonl(
     summaries: list[ConversationSummary], output_folder: Path
@@ -28,19 +17,17 @@ def dump_summary_to_jsonl(
 class SummaryModel:
     def __init__(
         self,
+        client=None,
     ):
 
-        # self.client = instructor.from_vertexai(
-        #     vertexai.generative_models.GenerativeModel("gemini-1.5-flash-001"), 
-        #     mode=instructor.Mode.VERTEXAI_TOOLS
-        # )
-
+        # Pass in instructor.from_vertexai(vertexai.generative_models.GenerativeModel("gemini-1.5-flash-001"), mode=instructor.Mode.VERTEXAI_TOOLS) to use Vertex AI instead
+        self._client = client
 
-        self.client = instructor.from_openai(        
-            AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"], base_url=os.environ["OPENAI_API_BASE"]),
-            # use_async=True,
-        )
-        
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_instructor_openai_client()
+        return self._client
 
     async def summarise(
         self, conversations: list[Conversation], output_folder: Path
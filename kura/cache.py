@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+class DiskCache:
+    """
+    A small key-value store backed by SQLite so that results can be shared across runs and across processes.
+
+    Entries are evicted in least recently used order once we exceed `max_entries`, and if `ttl` is set they expire `ttl` seconds after they were written.
+
+    The connection is shared between threads ( eg. when callers use `asyncio.to_thread` ) so every operation holds a lock.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                last_accessed REAL NOT NULL,
+                created_at REAL NOT NULL DEFAULT 0
+            )
+            """
+        )
+        # Caches written before entries could expire don't have a created_at column
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(cache)")}
+        if "created_at" not in columns:
+            self.conn.execute(
+                "ALTER TABLE cache ADD COLUMN created_at REAL NOT NULL DEFAULT 0"
+            )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_last_accessed ON cache (last_accessed)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)"
+        )
+        self.conn.commit()
+        # We keep a running count of the entries so that writes don't have to count the whole table to know whether to evict. Writes from other processes aren't counted so a shared cache can drift a little past `max_entries` until it's reopened
+        self.count = len(self)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM cache WHERE key = ? AND created_at >= ?",
+                (key, self.oldest_valid()),
+            ).fetchone()
+        return row is not None
+
+    def oldest_valid(self) -> float:
+        return time.time() - self.ttl if self.ttl is not None else float("-inf")
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: list[str]) -> dict[str, bytes]:
+        res: dict[str, bytes] = {}
+        oldest = self.oldest_valid()
+        with self.lock:
+            # SQLite caps the number of bound parameters so we look keys up in chunks
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({','.join('?' * len(chunk))}) AND created_at >= ?",
+                    [*chunk, oldest],
+                ).fetchall()
+                res.update({key: value for key, value in rows})
+
+            if res:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE cache SET last_accessed = ? WHERE key = ?",
+                    [(now, key) for key in res],
+                )
+                self.conn.commit()
+        return res
+
+    def set(self, key: str, value: bytes) -> None:
+        self.set_many({key: value})
+
+    def set_many(self, items: dict[str, bytes]) -> None:
+        if not items:
+            return
+        now = time.time()
+        keys = list(items)
+        with self.lock:
+            existing = 0
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                existing += self.conn.execute(
+                    f"SELECT COUNT(*) FROM cache WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchone()[0]
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, last_accessed, created_at) VALUES (?, ?, ?, ?)",
+                [(key, value, now, now) for key, value in items.items()],
+            )
+            self.conn.commit()
+            self.count += len(keys) - existing
+            self.evict()
+
+    def evict(self) -> int:
+        """Remove expired entries, then the least recently used ones until we're back under `max_entries`"""
+        with self.lock:
+            expired = 0
+            if self.ttl is not None:
+                expired = self.conn.execute(
+                    "DELETE FROM cache WHERE created_at < ?", (self.oldest_valid(),)
+                ).rowcount
+                self.conn.commit()
+                self.count -= expired
+
+            if self.max_entries is None:
+                return expired
+
+            excess = self.count - self.max_entries
+            if excess <= 0:
+                return expired
+
+            evicted = self.conn.execute(
+                """
+                DELETE FROM cache WHERE key IN (
+                    SELECT key FROM cache ORDER BY last_accessed ASC LIMIT ?
+                )
+                """,
+                (excess,),
+            ).rowcount
+            self.conn.commit()
+            self.count -= evicted
+            return expired + evicted
+
+    def clear(self) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM cache")
+            self.conn.commit()
+            self.count = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
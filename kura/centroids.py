@@ -0,0 +1,145 @@
+from typing import Optional, Sequence
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+class CentroidIndex:
+    """
+    A lookup table of cluster centroids that supports cosine nearest-neighbour queries.
+
+    Alongside the current centroid of each cluster we keep the number of items that it was computed from and a reference centroid ( the centroid at the time the cluster was labelled ) so that we can update clusters incrementally and measure how far they've drifted.
+    """
+
+    def __init__(
+        self,
+        ids: Sequence[str],
+        centroids: NDArray[np.float32],
+        counts: Optional[NDArray[np.int64]] = None,
+        reference: Optional[NDArray[np.float32]] = None,
+        max_memory_mb: int = 256,
+        embedding_model: Optional[str] = None,
+    ):
+        self.ids = list(ids)
+        # The name of the model the centroids were embedded with, vectors from any other model can't be compared with them
+        self.embedding_model = embedding_model
+        self.id_to_row = {id: row for row, id in enumerate(self.ids)}
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.counts = (
+            np.ones(len(self.ids), dtype=np.int64)
+            if counts is None
+            else np.asarray(counts, dtype=np.int64)
+        )
+        self.reference = (
+            self.centroids.copy()
+            if reference is None
+            else np.asarray(reference, dtype=np.float32)
+        )
+        self.max_memory_mb = max_memory_mb
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_groups(
+        cls,
+        ids: Sequence[str],
+        embeddings: NDArray[np.float32],
+        groups: Sequence[NDArray[np.int64]],
+    ) -> "CentroidIndex":
+        """Build an index where the centroid of `ids[i]` is the mean of `embeddings[groups[i]]`"""
+        return cls(
+            ids=ids,
+            centroids=np.stack([embeddings[rows].mean(axis=0) for rows in groups]),
+            counts=np.array([len(rows) for rows in groups], dtype=np.int64),
+        )
+
+    @staticmethod
+    def normalise(vectors: NDArray[np.float32]) -> NDArray[np.float32]:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def nearest(
+        self, vectors: NDArray[np.float32], k: int = 1, exclude_self: bool = False
+    ) -> tuple[NDArray[np.int64], NDArray[np.float32]]:
+        """
+        Return the rows of the `k` most similar centroids for each vector ( most similar first ) along with their cosine similarities.
+
+        With `exclude_self` the i-th vector is assumed to be the i-th centroid and is never returned as its own neighbour.
+        """
+        k = min(k, len(self) - 1 if exclude_self else len(self))
+        centroids = self.normalise(self.centroids)
+        vectors = self.normalise(np.asarray(vectors, dtype=np.float32))
+
+        indices = np.empty((len(vectors), max(k, 0)), dtype=np.int64)
+        similarities = np.empty((len(vectors), max(k, 0)), dtype=np.float32)
+        if k <= 0:
+            return indices, similarities
+
+        # We only ever materialise a (chunk, n_centroids) similarity matrix
+        chunk_size = max(1, self.max_memory_mb * 1024 * 1024 // (len(self) * 4))
+        for start in range(0, len(vectors), chunk_size):
+            sims = vectors[start : start + chunk_size] @ centroids.T
+            if exclude_self:
+                rows = np.arange(len(sims))
+                sims[rows, rows + start] = -np.inf
+
+            top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            top_sims = np.take_along_axis(sims, top, axis=1)
+            order = np.argsort(-top_sims, axis=1)
+            indices[start : start + len(sims)] = np.take_along_axis(top, order, axis=1)
+            similarities[start : start + len(sims)] = np.take_along_axis(
+                top_sims, order, axis=1
+            )
+
+        return indices, similarities
+
+    def neighbours(self, k: int) -> NDArray[np.int64]:
+        """The rows of the `k` nearest other centroids for every centroid in the index"""
+        return self.nearest(self.centroids, k, exclude_self=True)[0]
+
+    def add(self, row: int, vectors: NDArray[np.float32]) -> None:
+        """Fold new member embeddings into the running mean of a centroid"""
+        count = self.counts[row]
+        self.centroids[row] = (self.centroids[row] * count + vectors.sum(axis=0)) / (
+            count + len(vectors)
+        )
+        self.counts[row] = count + len(vectors)
+
+    def check_embedding_model(self, embedding_model: str) -> None:
+        if self.embedding_model is not None and self.embedding_model != embedding_model:
+            raise ValueError(
+                f"The centroids were embedded with {self.embedding_model} but the vectors come from {embedding_model}, they have to come from the same model"
+            )
+
+    def drift(self) -> NDArray[np.float32]:
+        """Cosine distance between each centroid and its reference centroid"""
+        return 1 - np.sum(
+            self.normalise(self.centroids) * self.normalise(self.reference), axis=1
+        )
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                ids=np.array(self.ids, dtype=str),
+                centroids=self.centroids,
+                counts=self.counts,
+                reference=self.reference,
+                embedding_model=np.array(self.embedding_model or "", dtype=str),
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "CentroidIndex":
+        with np.load(path) as data:
+            # Indexes saved before we recorded the model don't have it
+            embedding_model = (
+                str(data["embedding_model"]) if "embedding_model" in data else ""
+            )
+            return cls(
+                ids=data["ids"].tolist(),
+                centroids=data["centroids"],
+                counts=data["counts"],
+                reference=data["reference"],
+                embedding_model=embedding_model or None,
+            )
@@ -0,0 +1,267 @@
+from kura.base_classes import BaseCheckpointManager, BaseCheckpointWriter
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Optional, TextIO, TypeVar
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from pydantic_core import from_json, to_json
+import json
+import numpy as np
+import os
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+T = TypeVar("T", bound=BaseModel)
+R = TypeVar("R")
+
+
+class JSONLCheckpointWriter(BaseCheckpointWriter):
+    def __init__(self, f: TextIO):
+        self.f = f
+
+    def write(self, item: BaseModel) -> None:
+        # We flush every item so that an interrupted run loses at most the line that was being written
+        self.f.write(item.model_dump_json() + "\n")
+        self.f.flush()
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class JSONLCheckpointManager(BaseCheckpointManager):
+    """
+    Stores each checkpoint as one JSON object per line, this is the original format and is easy to inspect by hand.
+    """
+
+    def exists(self, checkpoint_path: str) -> bool:
+        return os.path.exists(checkpoint_path)
+
+    def read_lines(
+        self, checkpoint_path: str, parse: Callable[[str], R], errors: type[Exception]
+    ) -> Iterator[R]:
+        with open(checkpoint_path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield parse(line)
+                except errors:
+                    # A crash mid-write can leave a partial final line behind, anything else is a real error
+                    if line.endswith("\n"):
+                        raise
+                    print(f"Ignoring partially written line in {checkpoint_path}")
+
+    def load(self, checkpoint_path: str, response_model: type[T]) -> list[T]:
+        return list(
+            self.read_lines(
+                checkpoint_path, response_model.model_validate_json, ValidationError
+            )
+        )
+
+    def load_columns(
+        self, checkpoint_path: str, columns: list[str]
+    ) -> dict[str, Any]:
+        res: dict[str, list[Any]] = {column: [] for column in columns}
+        for row in self.read_lines(checkpoint_path, json.loads, json.JSONDecodeError):
+            for column in columns:
+                res[column].append(row[column])
+        return res
+
+    def save(self, checkpoint_path: str, items: list[BaseModel]) -> None:
+        with open(checkpoint_path, "w") as f:
+            for item in items:
+                f.write(item.model_dump_json() + "\n")
+
+    def open_writer(self, checkpoint_path: str) -> JSONLCheckpointWriter:
+        # Drop any partially written final line so that new items start on a line of their own
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "rb+") as f:
+                content = f.read()
+                if content and not content.endswith(b"\n"):
+                    f.truncate(content.rfind(b"\n") + 1)
+        return JSONLCheckpointWriter(open(checkpoint_path, "a"))
+
+
+def import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(
+            "The Parquet checkpoint backend requires pyarrow, install it with `pip install kura[parquet]`"
+        ) from e
+    return pa, pq
+
+
+class ParquetCheckpointWriter(BaseCheckpointWriter):
+    def __init__(self, manager: "ParquetCheckpointManager", checkpoint_dir: Path):
+        self.manager = manager
+        self.checkpoint_dir = checkpoint_dir
+        self.buffer: list[BaseModel] = []
+
+    def write(self, item: BaseModel) -> None:
+        self.buffer.append(item)
+        if len(self.buffer) >= self.manager.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        self.manager.write_part(self.checkpoint_dir, self.buffer)
+        self.buffer = []
+
+    def close(self) -> None:
+        self.flush()
+
+
+class ParquetCheckpointManager(BaseCheckpointManager):
+    """
+    Stores each checkpoint as a directory of Parquet files so that large checkpoints load in a fraction of the time and individual columns can be read on their own.
+
+    Fields holding equal length lists of floats ( eg. embeddings ) are stored as fixed size float32 list columns and come back from `load_columns` as a 2D numpy array. Dict fields such as summary metadata are stored as JSON.
+
+    Appended items are buffered and written out as a new part file every `buffer_size` items, so an interrupted run loses at most the items in the current buffer.
+    """
+
+    JSON_COLUMNS_KEY = b"kura_json_columns"
+
+    def __init__(self, buffer_size: int = 1000, compression: str = "zstd"):
+        self.buffer_size = buffer_size
+        self.compression = compression
+
+    def path(self, checkpoint_path: str) -> str:
+        return str(Path(checkpoint_path).with_suffix(".parquet"))
+
+    def parts(self, checkpoint_path: str) -> list[Path]:
+        return sorted(Path(self.path(checkpoint_path)).glob("part-*.parquet"))
+
+    def exists(self, checkpoint_path: str) -> bool:
+        return os.path.isdir(self.path(checkpoint_path))
+
+    @staticmethod
+    def is_vector_column(values: list[Any]) -> bool:
+        first = values[0]
+        if not isinstance(first, (list, np.ndarray)) or len(first) == 0:
+            return False
+        if not isinstance(first[0], (float, np.floating)):
+            return False
+        return all(
+            isinstance(value, (list, np.ndarray)) and len(value) == len(first)
+            for value in values
+        )
+
+    def to_table(self, items: list[BaseModel]) -> "pa.Table":
+        pa, _ = import_pyarrow()
+
+        # Computed fields ( eg. Cluster.count ) are derived on load so we only store the declared fields
+        fields = list(type(items[0]).model_fields)
+
+        arrays = {}
+        json_columns = []
+        for field in fields:
+            values = [getattr(item, field) for item in items]
+            if any(isinstance(value, (dict, BaseModel)) for value in values):
+                arrays[field] = pa.array(
+                    [None if value is None else to_json(value) for value in values],
+                    type=pa.binary(),
+                )
+                json_columns.append(field)
+            elif self.is_vector_column(values):
+                flat = np.asarray(values, dtype=np.float32).reshape(-1)
+                arrays[field] = pa.FixedSizeListArray.from_arrays(
+                    pa.array(flat), len(values[0])
+                )
+            else:
+                arrays[field] = pa.array(values)
+
+        return pa.table(arrays).replace_schema_metadata(
+            {self.JSON_COLUMNS_KEY: json.dumps(json_columns)}
+        )
+
+    def write_part(self, checkpoint_dir: Path, items: list[BaseModel]) -> Path:
+        _, pq = import_pyarrow()
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+
+        existing = sorted(checkpoint_dir.glob("part-*.parquet"))
+        index = int(existing[-1].stem.split("-")[1]) + 1 if existing else 0
+        part = checkpoint_dir / f"part-{index:05d}.parquet"
+
+        # Write to a hidden file first so that readers never see a half written part
+        tmp = checkpoint_dir / f".{part.name}.tmp"
+        pq.write_table(self.to_table(items), tmp, compression=self.compression)
+        os.replace(tmp, part)
+        return part
+
+    def read_table(
+        self, checkpoint_path: str, columns: Optional[list[str]] = None
+    ) -> tuple[Optional["pa.Table"], list[str]]:
+        pa, pq = import_pyarrow()
+        parts = self.parts(checkpoint_path)
+        if not parts:
+            return None, []
+
+        # Parts are written separately so a dict field that was empty in one of them can still be JSON in another, we only need the footers to find out
+        json_columns: list[str] = []
+        for part in parts:
+            metadata = pq.read_schema(part).metadata or {}
+            for column in json.loads(metadata.get(self.JSON_COLUMNS_KEY, b"[]")):
+                if column not in json_columns:
+                    json_columns.append(column)
+        table = pa.concat_tables(
+            [pq.read_table(part, columns=columns) for part in parts],
+            promote_options="default",
+        )
+        return table, json_columns
+
+    def load(self, checkpoint_path: str, response_model: type[T]) -> list[T]:
+        table, json_columns = self.read_table(checkpoint_path)
+        if table is None:
+            return []
+
+        columns = table.to_pydict()
+        for column in json_columns:
+            columns[column] = [
+                None if value is None else from_json(value)
+                for value in columns[column]
+            ]
+
+        # Validating the whole list in one call is much faster than validating row by row
+        names = list(columns)
+        return TypeAdapter(list[response_model]).validate_python(
+            [dict(zip(names, row)) for row in zip(*columns.values())]
+        )
+
+    def load_columns(
+        self, checkpoint_path: str, columns: list[str]
+    ) -> dict[str, Any]:
+        pa, _ = import_pyarrow()
+        table, json_columns = self.read_table(checkpoint_path, columns)
+        if table is None:
+            return {column: [] for column in columns}
+
+        res: dict[str, Any] = {}
+        for column in columns:
+            values = table.column(column)
+            if pa.types.is_fixed_size_list(values.type):
+                flat = values.combine_chunks().flatten().to_numpy()
+                res[column] = flat.reshape(len(values), values.type.list_size)
+            elif column in json_columns:
+                res[column] = [
+                    None if value is None else from_json(value)
+                    for value in values.to_pylist()
+                ]
+            else:
+                res[column] = values.to_pylist()
+        return res
+
+    def save(self, checkpoint_path: str, items: list[BaseModel]) -> None:
+        checkpoint_dir = Path(self.path(checkpoint_path))
+        old_parts = self.parts(checkpoint_path)
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        if items:
+            new_part = self.write_part(checkpoint_dir, items)
+            old_parts = [part for part in old_parts if part != new_part]
+        for part in old_parts:
+            part.unlink()
+
+    def open_writer(self, checkpoint_path: str) -> ParquetCheckpointWriter:
+        return ParquetCheckpointWriter(self, Path(self.path(checkpoint_path)))
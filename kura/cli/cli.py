@@ -1,6 +1,4 @@
 import typer
-import uvicorn
-from kura.cli.server import api
 from rich import print
 import os
 
@@ -13,9 +11,25 @@ def start_app(
         "./checkpoints",
         help="Directory to use for checkpoints, relative to the current directory",
     ),
+    workers: int = typer.Option(
+        1,
+        help="Number of analyses that can run at the same time, the rest wait in a queue",
+    ),
+    checkpoint_format: str = typer.Option(
+        "jsonl",
+        help="Format to store checkpoints in, either jsonl or parquet",
+    ),
 ):
     """Start the FastAPI server"""
+    # The server reads its configuration when it's imported so this has to be set first
     os.environ["KURA_CHECKPOINT_DIR"] = dir
+    os.environ["KURA_JOB_WORKERS"] = str(workers)
+    os.environ["KURA_CHECKPOINT_FORMAT"] = checkpoint_format
+
+    # The server pulls in FastAPI, pandas and the whole pipeline so we only import it when we actually start it
+    import uvicorn
+    from kura.cli.server import api
+
     uvicorn.run(api, host="0.0.0.0", port=8000)
     print(
         "\n[bold green]🚀 Access website at[/bold green] [bold blue][http://localhost:8000](http://localhost:8000)[/bold blue]\n"
@@ -0,0 +1,357 @@
+"""
+Run analyses in the background so that long pipelines don't tie up the request that started them.
+
+Each job gets its own checkpoint directory under the job manager's root, so a job that is interrupted ( eg. by a restart ) picks up from its checkpoints when it's requeued.
+
+Jobs run on their own thread with their own event loop. Parts of the pipeline are CPU bound ( eg. fitting UMAP ) and would otherwise stall every other request the server is handling, including the ones polling for progress.
+"""
+
+import asyncio
+import json
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Callable, Literal, Optional
+
+from pydantic import BaseModel, Field, TypeAdapter
+
+from kura import Kura
+from kura.base_classes import BaseCheckpointManager
+from kura.metrics import MetricsCallback, MetricsRecorder, StageMetrics
+from kura.types import Conversation, ProjectedCluster
+
+JobStatus = Literal["queued", "running", "completed", "failed"]
+
+conversations_adapter = TypeAdapter(list[Conversation])
+
+
+class Job(BaseModel):
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    status: JobStatus = "queued"
+    checkpoint_dir: str
+    max_clusters: int = 10
+    disable_checkpoints: bool = False
+    created_at: float = Field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    stage: Optional[str] = None
+    completed_stages: list[str] = []
+    requests: int = 0
+    error: Optional[str] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "failed")
+
+
+class JobEvent(BaseModel):
+    type: Literal["status", "stage_start", "stage_end", "progress"]
+    job: Job
+    data: dict = {}
+    timestamp: float = Field(default_factory=time.time)
+
+
+def default_kura_factory(
+    job: Job,
+    metrics: MetricsRecorder,
+    checkpoint_manager: Optional[BaseCheckpointManager] = None,
+) -> Kura:
+    return Kura(
+        checkpoint_dir=job.checkpoint_dir,
+        max_clusters=job.max_clusters,
+        disable_checkpoints=job.disable_checkpoints,
+        checkpoint_manager=checkpoint_manager,
+        metrics=metrics,
+    )
+
+
+def start_numba_threads() -> None:
+    """
+    Start numba's threading layer from the main thread.
+
+    UMAP runs parallel numba code and if the threading layer is first started from one of our job threads the interpreter hangs when it tries to exit.
+    """
+    try:
+        import numba
+    except ImportError:
+        return
+
+    @numba.njit(parallel=True)
+    def warm_up(n: int) -> int:
+        total = 0
+        for i in numba.prange(n):
+            total += i
+        return total
+
+    warm_up(1)
+
+
+class JobProgress(MetricsCallback):
+    """
+    Turns the metrics recorded while a job runs into progress events.
+
+    Metrics are recorded on the job's thread so every update to the job is handed back to the manager's event loop.
+    """
+
+    def __init__(
+        self,
+        manager: "JobManager",
+        job: Job,
+        loop: asyncio.AbstractEventLoop,
+        interval: float = 1.0,
+    ):
+        self.manager = manager
+        self.job = job
+        self.loop = loop
+        self.interval = interval
+        self.last_progress = 0.0
+        self.requests = 0
+
+    def call(self, callback: Callable[..., None], *args) -> None:
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The server's loop has already closed, there's nobody left to tell
+            pass
+
+    def on_stage_start(self, stage: str) -> None:
+        self.call(self.stage_started, stage)
+
+    def on_stage_end(self, stage: StageMetrics) -> None:
+        self.call(self.stage_ended, stage.name, stage.report(), self.requests)
+
+    def on_request(
+        self, stage: str, kind: str, latency: float, success: bool, retries: int
+    ) -> None:
+        self.requests += 1
+        # Stages make thousands of requests so we only report progress every `interval` seconds
+        now = time.monotonic()
+        if now - self.last_progress >= self.interval:
+            self.last_progress = now
+            self.call(self.progressed, stage, self.requests)
+
+    def stage_started(self, stage: str) -> None:
+        self.job.stage = stage
+        self.manager.publish(self.job, "stage_start", {"stage": stage})
+
+    def stage_ended(self, stage: str, report: dict, requests: int) -> None:
+        self.job.completed_stages.append(stage)
+        self.job.requests = requests
+        self.manager.publish(self.job, "stage_end", report)
+
+    def progressed(self, stage: str, requests: int) -> None:
+        self.job.requests = requests
+        self.manager.publish(self.job, "progress", {"stage": stage})
+
+
+class JobManager:
+    def __init__(
+        self,
+        root_dir: str,
+        workers: int = 1,
+        kura_factory: Callable[[Job, MetricsRecorder], Kura] = default_kura_factory,
+        metrics: Optional[MetricsRecorder] = None,
+    ):
+        self.root_dir = Path(root_dir)
+        self.workers = workers
+        self.kura_factory = kura_factory
+        self.metrics = metrics
+
+        self.jobs: dict[str, Job] = {}
+        self.events: dict[str, list[JobEvent]] = {}
+        self.subscribers: dict[str, list[asyncio.Queue]] = {}
+        self.results: dict[str, asyncio.Future] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: list[asyncio.Task] = []
+        # Conversations for jobs that don't keep checkpoints only live in memory
+        self.pending: dict[str, list[Conversation]] = {}
+
+    def job_dir(self, job_id: str) -> Path:
+        return self.root_dir / job_id
+
+    def save_job(self, job: Job) -> None:
+        if job.disable_checkpoints:
+            return
+        path = Path(job.checkpoint_dir) / "job.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(job.model_dump_json())
+
+    async def start(self) -> None:
+        start_numba_threads()
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+        # Jobs that were queued or running when we last stopped are picked up again, their checkpoints let them resume where they left off
+        if self.root_dir.exists():
+            for path in sorted(self.root_dir.glob("*/job.json")):
+                job = Job.model_validate_json(path.read_text())
+                self.jobs[job.id] = job
+                self.events[job.id] = []
+                if not job.done:
+                    self.enqueue(job)
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def enqueue(self, job: Job) -> None:
+        if self.queue is None:
+            raise RuntimeError("JobManager.start must be called before submitting jobs")
+        job.status = "queued"
+        self.results[job.id] = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(job.id)
+        self.publish(job, "status")
+
+    def submit(
+        self,
+        conversations: list[Conversation],
+        max_clusters: int = 10,
+        checkpoint_dir: Optional[str] = None,
+        disable_checkpoints: bool = False,
+    ) -> Job:
+        job_id = uuid.uuid4().hex
+        job = Job(
+            id=job_id,
+            checkpoint_dir=checkpoint_dir or str(self.job_dir(job_id)),
+            max_clusters=max_clusters,
+            disable_checkpoints=disable_checkpoints,
+        )
+        self.jobs[job.id] = job
+        self.events[job.id] = []
+
+        if disable_checkpoints:
+            self.pending[job.id] = conversations
+        else:
+            # We keep the conversations on disk rather than in memory while the job waits in the queue
+            Path(job.checkpoint_dir).mkdir(parents=True, exist_ok=True)
+            self.conversations_path(job).write_bytes(
+                conversations_adapter.dump_json(conversations)
+            )
+            self.save_job(job)
+
+        self.enqueue(job)
+        return job
+
+    def conversations_path(self, job: Job) -> Path:
+        return Path(job.checkpoint_dir) / "conversations.json"
+
+    def load_conversations(self, job: Job) -> list[Conversation]:
+        if job.id in self.pending:
+            return self.pending[job.id]
+        return conversations_adapter.validate_json(
+            self.conversations_path(job).read_bytes()
+        )
+
+    def publish(self, job: Job, type: str, data: Optional[dict] = None) -> None:
+        event = JobEvent(type=type, job=job.model_copy(deep=True), data=data or {})
+        self.events.setdefault(job.id, []).append(event)
+        for queue in self.subscribers.get(job.id, []):
+            queue.put_nowait(event)
+
+    async def subscribe(self, job_id: str) -> AsyncIterator[JobEvent]:
+        """Yield every event for a job, starting with the ones that have already happened, until it finishes"""
+        job = self.jobs[job_id]
+        if job.done and not self.events.get(job_id):
+            # Jobs restored from disk have no history, all we can report is how they ended
+            yield JobEvent(type="status", job=job)
+            return
+
+        queue: asyncio.Queue = asyncio.Queue()
+        self.subscribers.setdefault(job_id, []).append(queue)
+        try:
+            for event in list(self.events.get(job_id, [])):
+                yield event
+                if event.job.done:
+                    return
+            while True:
+                event = await queue.get()
+                yield event
+                if event.job.done:
+                    return
+        finally:
+            self.subscribers[job_id].remove(queue)
+
+    async def wait(self, job_id: str) -> list[ProjectedCluster]:
+        return await asyncio.shield(self.results[job_id])
+
+    async def worker(self) -> None:
+        assert self.queue is not None
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self.run(self.jobs[job_id])
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job: Job) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        self.save_job(job)
+        self.publish(job, "status")
+
+        metrics = MetricsRecorder(
+            callbacks=[JobProgress(self, job, asyncio.get_running_loop())]
+        )
+        result = self.results[job.id]
+        try:
+            clusters = await self.run_in_thread(job, metrics)
+        except Exception as e:
+            job.status = "failed"
+            job.error = f"{type(e).__name__}: {e}"
+            if not result.done():
+                result.set_exception(e)
+                # Nobody might be waiting on this job, we don't want asyncio to complain about an unretrieved exception
+                result.exception()
+        else:
+            job.status = "completed"
+            if not result.done():
+                result.set_result(clusters)
+        finally:
+            job.finished_at = time.time()
+            job.stage = None
+            self.pending.pop(job.id, None)
+            if self.metrics is not None:
+                self.metrics.merge(metrics)
+            self.save_job(job)
+            self.publish(job, "status")
+
+    def run_in_thread(
+        self, job: Job, metrics: MetricsRecorder
+    ) -> "asyncio.Future[list[ProjectedCluster]]":
+        """
+        Run the pipeline for a job on a new thread with its own event loop.
+
+        The thread is a daemon so that stopping the server doesn't wait for a long job to finish, the job is still marked as running on disk and is requeued on the next start.
+        """
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[list[ProjectedCluster]] = loop.create_future()
+
+        def settle(set_outcome: Callable, value) -> None:
+            if not future.done():
+                set_outcome(value)
+
+        def target() -> None:
+            try:
+                kura = self.kura_factory(job, metrics)
+                clusters = asyncio.run(
+                    kura.cluster_conversations(self.load_conversations(job))
+                )
+            except BaseException as e:
+                outcome = (settle, future.set_exception, e)
+            else:
+                outcome = (settle, future.set_result, clusters)
+            try:
+                loop.call_soon_threadsafe(*outcome)
+            except RuntimeError:
+                # The server's loop has already closed
+                pass
+
+        threading.Thread(target=target, name=f"kura-job-{job.id}", daemon=True).start()
+        return future
+
+
+def format_sse(event: JobEvent) -> str:
+    return f"event: {event.type}\ndata: {json.dumps(event.model_dump(mode='json'))}\n\n"
@@ -1,20 +1,67 @@
-from fastapi import FastAPI, staticfiles
+from fastapi import FastAPI, HTTPException, staticfiles
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 from pathlib import Path
-from kura import Kura
+from kura.base_classes import BaseCheckpointManager
+from kura.cache import DiskCache
+from kura.checkpoint import JSONLCheckpointManager, ParquetCheckpointManager
+from kura.metrics import MetricsRecorder
 from kura.types import ProjectedCluster, Conversation
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import partial
 from typing import Optional
+from kura.cli.jobs import Job, JobManager, default_kura_factory, format_sse
 from kura.cli.visualisation import (
+    build_weekly_frame,
     generate_cumulative_chart_data,
     generate_messages_per_chat_data,
     generate_messages_per_week_data,
     generate_new_chats_per_week_data,
 )
+import asyncio
+import hashlib
 import json
+import os
 
+checkpoint_dir = Path(os.environ.get("KURA_CHECKPOINT_DIR", "./checkpoints"))
+CHECKPOINT_MANAGERS: dict[str, type[BaseCheckpointManager]] = {
+    "jsonl": JSONLCheckpointManager,
+    "parquet": ParquetCheckpointManager,
+}
+checkpoint_format = os.environ.get("KURA_CHECKPOINT_FORMAT", "jsonl")
+if checkpoint_format not in CHECKPOINT_MANAGERS:
+    raise ValueError(
+        f"Unknown checkpoint format {checkpoint_format!r}, expected one of {', '.join(CHECKPOINT_MANAGERS)}"
+    )
+checkpoint_manager = CHECKPOINT_MANAGERS[checkpoint_format]()
+# Kura's default name for the projected clusters, the checkpoint manager swaps the extension for its own format
+DIMENSIONALITY_CHECKPOINT_NAME = "dimensionality.jsonl"
 
-api = FastAPI()
+# Metrics accumulate across every analysis this server runs
+metrics = MetricsRecorder()
+
+# Pipelines run on a fixed number of background workers, everything else waits in the queue
+job_manager = JobManager(
+    root_dir=str(checkpoint_dir / "jobs"),
+    workers=int(os.environ.get("KURA_JOB_WORKERS", "1")),
+    kura_factory=partial(default_kura_factory, checkpoint_manager=checkpoint_manager),
+    metrics=metrics,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Importing the server shouldn't touch the disk so the response cache's database is only opened once we start
+    response_cache.open()
+    await job_manager.start()
+    yield
+    await job_manager.stop()
+    response_cache.close()
+
+
+api = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 api.add_middleware(
@@ -37,36 +84,213 @@ class ConversationData(BaseModel):
     disable_checkpoints: bool
 
 
+class ClusterCheckpoint:
+    """
+    Keeps the parsed clusters from a checkpoint in memory and only reloads them when the checkpoint's modification time changes.
+
+    Parquet checkpoints are directories whose modification time changes whenever a part is added or removed.
+    """
+
+    def __init__(self, manager: BaseCheckpointManager, checkpoint_path: str):
+        self.manager = manager
+        self.checkpoint_path = checkpoint_path
+        self.mtime: Optional[int] = None
+        self.clusters: list[ProjectedCluster] = []
+
+    def version(self) -> Optional[int]:
+        if not self.manager.exists(self.checkpoint_path):
+            return None
+        return os.stat(self.manager.path(self.checkpoint_path)).st_mtime_ns
+
+    def load(self) -> list[ProjectedCluster]:
+        mtime = self.version()
+        if mtime != self.mtime:
+            self.clusters = self.manager.load(self.checkpoint_path, ProjectedCluster)
+            self.mtime = mtime
+        return self.clusters
+
+    def save(self, clusters: list[ProjectedCluster]) -> None:
+        self.manager.save(self.checkpoint_path, clusters)
+
+
+class ResponseCache:
+    """
+    Serialised responses kept in an in-process LRU in front of a SQLite cache so that they also survive restarts.
+    """
+
+    def __init__(
+        self, path: str, max_memory_entries: int = 16, max_disk_entries: int = 256
+    ):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory: OrderedDict[str, bytes] = OrderedDict()
+        # Until `open` is called responses are only kept in memory
+        self.disk: Optional[DiskCache] = None
+
+    def open(self) -> None:
+        if self.disk is None:
+            self.disk = DiskCache(self.path, max_entries=self.max_disk_entries)
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+    def get(self, key: str) -> Optional[bytes]:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        value = self.disk.get(key) if self.disk is not None else None
+        if value is not None:
+            self.remember(key, value)
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        self.remember(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def remember(self, key: str, value: bytes) -> None:
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+
+cluster_checkpoint = ClusterCheckpoint(
+    checkpoint_manager, str(checkpoint_dir / DIMENSIONALITY_CHECKPOINT_NAME)
+)
+response_cache = ResponseCache(str(checkpoint_dir / "analyse_cache.db"))
+conversations_adapter = TypeAdapter(list[Conversation])
+
+
+def dataset_fingerprint(conversation_data: ConversationData) -> str:
+    digest = hashlib.sha256(conversations_adapter.dump_json(conversation_data.data))
+    digest.update(f"\0{conversation_data.max_clusters}".encode())
+    return digest.hexdigest()
+
+
+def response_cache_key(fingerprint: str, checkpoint_version: Optional[int]) -> str:
+    # The clusters come from the checkpoint so a newer checkpoint has to invalidate the responses built from the old one
+    return f"{fingerprint}:{checkpoint_version}"
+
+
+def build_response(
+    conversations: list[Conversation], clusters: list[ProjectedCluster]
+) -> bytes:
+    weekly = build_weekly_frame(conversations)
+    return json.dumps(
+        {
+            "cumulative_words": generate_cumulative_chart_data(conversations, weekly),
+            "messages_per_chat": generate_messages_per_chat_data(conversations, weekly),
+            "messages_per_week": generate_messages_per_week_data(conversations, weekly),
+            "new_chats_per_week": generate_new_chats_per_week_data(
+                conversations, weekly
+            ),
+            "clusters": [cluster.model_dump(mode="json") for cluster in clusters],
+        }
+    ).encode()
+
+
 @api.post("/api/analyse")
 async def analyse_conversations(conversation_data: ConversationData):
-    print(conversation_data.disable_checkpoints)
-    # Load clusters from checkpoint file if it exists
-    clusters_file = Path("./checkpoints") / "dimensionality.jsonl"
-    if not clusters_file.exists() or conversation_data.disable_checkpoints:
-        kura = Kura(
-            checkpoint_dir=str(clusters_file.parent),
-            max_clusters=conversation_data.max_clusters
-            if conversation_data.max_clusters
-            else 10,
+    # Hashing the conversations and building the charts are CPU bound so they run off the event loop, as do the jobs themselves
+    fingerprint = await asyncio.to_thread(dataset_fingerprint, conversation_data)
+    if not conversation_data.disable_checkpoints:
+        cached = response_cache.get(
+            response_cache_key(fingerprint, cluster_checkpoint.version())
+        )
+        if cached is not None:
+            return Response(content=cached, media_type="application/json")
+
+    # Load clusters from checkpoint file if it exists, otherwise we wait for a worker to run the pipeline
+    if cluster_checkpoint.version() is None or conversation_data.disable_checkpoints:
+        job = job_manager.submit(
+            conversation_data.data,
+            max_clusters=conversation_data.max_clusters or 10,
             disable_checkpoints=conversation_data.disable_checkpoints,
         )
-        clusters = await kura.cluster_conversations(conversation_data.data)
+        clusters = await job_manager.wait(job.id)
+        if not conversation_data.disable_checkpoints:
+            # The job keeps its checkpoints in its own directory, later analyses load the clusters from the top level checkpoint
+            await asyncio.to_thread(cluster_checkpoint.save, clusters)
     else:
-        with open(clusters_file) as f:
-            clusters_data = []
-            for line in f:
-                clusters_data.append(line)
-            clusters = [
-                ProjectedCluster(**json.loads(cluster)) for cluster in clusters_data
-            ]
-
-    return {
-        "cumulative_words": generate_cumulative_chart_data(conversation_data.data),
-        "messages_per_chat": generate_messages_per_chat_data(conversation_data.data),
-        "messages_per_week": generate_messages_per_week_data(conversation_data.data),
-        "new_chats_per_week": generate_new_chats_per_week_data(conversation_data.data),
-        "clusters": clusters,
-    }
+        clusters = await asyncio.to_thread(cluster_checkpoint.load)
+
+    content = await asyncio.to_thread(
+        build_response, conversation_data.data, clusters
+    )
+    if not conversation_data.disable_checkpoints:
+        response_cache.set(
+            response_cache_key(fingerprint, cluster_checkpoint.version()), content
+        )
+    return Response(content=content, media_type="application/json")
+
+
+def get_job(job_id: str) -> Job:
+    job = job_manager.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+@api.post("/api/jobs")
+async def submit_job(conversation_data: ConversationData) -> Job:
+    # Results are served from the job's checkpoint directory so jobs always keep their checkpoints
+    return job_manager.submit(
+        conversation_data.data, max_clusters=conversation_data.max_clusters or 10
+    )
+
+
+@api.get("/api/jobs/{job_id}")
+async def job_status(job_id: str) -> Job:
+    return get_job(job_id)
+
+
+@api.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    get_job(job_id)
+
+    async def stream():
+        async for event in job_manager.subscribe(job_id):
+            yield format_sse(event)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@api.get("/api/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = get_job(job_id)
+    if job.status != "completed":
+        raise HTTPException(
+            status_code=409, detail=f"Job {job_id} is {job.status}, not completed"
+        )
+
+    checkpoint = ClusterCheckpoint(
+        checkpoint_manager,
+        str(Path(job.checkpoint_dir) / DIMENSIONALITY_CHECKPOINT_NAME),
+    )
+    key = response_cache_key(f"job:{job.id}", checkpoint.version())
+    content = response_cache.get(key)
+    if content is None:
+        content = await asyncio.to_thread(
+            lambda: build_response(
+                job_manager.load_conversations(job), checkpoint.load()
+            )
+        )
+        response_cache.set(key, content)
+    return Response(content=content, media_type="application/json")
+
+
+if os.environ.get("KURA_METRICS_ENDPOINT", "").lower() in ("1", "true", "yes"):
+
+    @api.get("/metrics", response_class=PlainTextResponse)
+    async def prometheus_metrics():
+        return PlainTextResponse(
+            metrics.to_prometheus(), media_type="text/plain; version=0.0.4"
+        )
 
 
 # Serve static files from web/dist at the root
@@ -1,125 +1,115 @@
 import pandas as pd
-from typing import List
+from typing import List, Optional
 from kura.types import Conversation
 
 
-def generate_cumulative_chart_data(conversations: List[Conversation]) -> dict:
+def to_datetime(values: list) -> pd.Series:
+    # Timestamps keep their wall clock time so weeks line up with the timezone the data was recorded in
+    return pd.Series(
+        pd.to_datetime([value.replace(tzinfo=None) for value in values]),
+        dtype="datetime64[ns]",
+    )
+
+
+def week_start(datetimes: pd.Series) -> pd.Series:
+    return datetimes.dt.to_period("W-MON").dt.start_time
+
+
+def build_message_frame(conversations: List[Conversation]) -> pd.DataFrame:
     """
-    Generate cumulative word count chart data for human messages in conversations.
-    Returns a dict containing the Plotly data and layout.
+    Build a single columnar frame with one row per message that every chart is computed from.
     """
-    messages_data = []
-    for conv in conversations:
-        for msg in conv.messages:
-            if msg.role == "user":
-                messages_data.append(
-                    {
-                        "datetime": pd.to_datetime(
-                            str(msg.created_at).replace("Z", "+00:00")
-                        ),
-                        "words": len(msg.content.split()),
-                    }
-                )
-
-    df = pd.DataFrame(messages_data)
-    df["week_start"] = df["datetime"].dt.to_period("W-MON").dt.start_time
-
-    weekly_df = df.groupby("week_start")["words"].sum().reset_index()
-    weekly_df["cumulative_words"] = weekly_df["words"].cumsum()
-    weekly_df["week_start"] = weekly_df["week_start"].dt.strftime("%Y-%m-%d")
-
-    return [
-        {"x": x, "y": y}
-        for x, y in zip(
-            weekly_df["week_start"].tolist(), weekly_df["cumulative_words"].tolist()
-        )
-    ]  # pyright: ignore
-
-
-def generate_messages_per_chat_data(conversations: List[Conversation]) -> dict:
-    messages_data = []
-    for conv in conversations:
-        for msg in conv.messages:
-            messages_data.append(
-                {
-                    "datetime": pd.to_datetime(
-                        str(msg.created_at).replace("Z", "+00:00")
-                    ),
-                    "chat_id": conv.chat_id,
-                }
-            )
-
-    df = pd.DataFrame(messages_data)
-    df["week_start"] = df["datetime"].dt.to_period("W-MON").dt.start_time
-
-    weekly_messages = df.groupby("week_start").size().reset_index(name="message_count")  # pyright: ignore
-    weekly_chats = (
-        df.groupby("week_start")["chat_id"].nunique().reset_index(name="chat_count")  # pyright: ignore
+    messages = [
+        (conv.chat_id, msg.created_at, msg.role == "user", len(msg.content.split()))
+        for conv in conversations
+        for msg in conv.messages
+    ]
+    chat_ids, created_at, is_user, words = (
+        zip(*messages) if messages else ((), (), (), ())
     )
+    df = pd.DataFrame(
+        {
+            "chat_id": pd.Series(chat_ids, dtype="object"),
+            "datetime": to_datetime(list(created_at)),
+            "is_user": pd.Series(is_user, dtype="bool"),
+            "words": pd.Series(words, dtype="int64"),
+        }
+    )
+    df["week_start"] = week_start(df["datetime"])
+    return df
 
-    weekly_df = pd.merge(weekly_messages, weekly_chats, on="week_start")
-    weekly_df["avg_messages"] = weekly_df["message_count"] / weekly_df["chat_count"]
-    weekly_df["week_start"] = weekly_df["week_start"].dt.strftime("%Y-%m-%d")
 
-    return [
-        {"x": x, "y": y}
-        for x, y in zip(
-            weekly_df["week_start"].tolist(), weekly_df["avg_messages"].tolist()
-        )
-    ]  # pyright: ignore
-
-
-def generate_messages_per_week_data(conversations: List[Conversation]) -> dict:
-    messages_data = []
-    for conv in conversations:
-        for msg in conv.messages:
-            messages_data.append(
-                {
-                    "datetime": pd.to_datetime(
-                        str(msg.created_at).replace("Z", "+00:00")
-                    ),
-                    "chat_id": conv.chat_id,
-                }
-            )
-
-    df = pd.DataFrame(messages_data)
-    df["week_start"] = df["datetime"].dt.to_period("W-MON").dt.start_time
-
-    weekly_messages = df.groupby("week_start").size().reset_index(name="message_count")  # pyright: ignore
-    weekly_messages["week_start"] = weekly_messages["week_start"].dt.strftime(
-        "%Y-%m-%d"
-    )  # pyright: ignore
+def build_weekly_frame(conversations: List[Conversation]) -> pd.DataFrame:
+    """
+    Compute every weekly series used by the dashboard in a single groupby over the message frame, add new series here as extra aggregations.
 
-    return [
-        {"x": x, "y": y}
-        for x, y in zip(
-            weekly_messages["week_start"].tolist(),
-            weekly_messages["message_count"].tolist(),
-        )
-    ]  # pyright: ignore
-
-
-def generate_new_chats_per_week_data(conversations: List[Conversation]) -> dict:
-    chat_starts = pd.DataFrame(
-        [
-            {
-                "datetime": pd.to_datetime(str(conv.created_at).replace("Z", "+00:00")),
-                "chat_id": conv.chat_id,
-            }
-            for conv in conversations
-        ]
+    The result is indexed by the start of each week and only contains weeks that have at least one message or new chat.
+    """
+    messages = build_message_frame(conversations)
+    messages["user_messages"] = messages["is_user"].astype("int64")
+    messages["user_words"] = messages["words"].where(messages["is_user"], 0)
+
+    weekly = messages.groupby("week_start").agg(
+        message_count=("chat_id", "size"),
+        chat_count=("chat_id", "nunique"),
+        user_messages=("user_messages", "sum"),
+        user_words=("user_words", "sum"),
     )
-    chat_starts["week_start"] = (
-        chat_starts["datetime"].dt.to_period("W-MON").dt.start_time
+
+    new_chats = (
+        week_start(to_datetime([conv.created_at for conv in conversations]))
+        .value_counts()
+        .rename("new_chats")
     )
-    weekly_chats = (
-        chat_starts.groupby("week_start").size().reset_index(name="chat_count")  # pyright: ignore
+    weekly = weekly.join(new_chats, how="outer").fillna(0).sort_index()
+    weekly["cumulative_words"] = weekly["user_words"].cumsum()
+    weekly["avg_messages"] = weekly["message_count"] / weekly["chat_count"].where(
+        weekly["chat_count"] > 0
     )
-    weekly_chats["week_start"] = weekly_chats["week_start"].dt.strftime("%Y-%m-%d")
+    return weekly
+
 
+def to_points(series: pd.Series) -> list[dict]:
     return [
         {"x": x, "y": y}
-        for x, y in zip(
-            weekly_chats["week_start"].tolist(), weekly_chats["chat_count"].tolist()
-        )
-    ]  # pyright: ignore
+        for x, y in zip(series.index.strftime("%Y-%m-%d").tolist(), series.tolist())
+    ]
+
+
+def generate_cumulative_chart_data(
+    conversations: List[Conversation], weekly: Optional[pd.DataFrame] = None
+) -> list[dict]:
+    """
+    Generate cumulative word count chart data for human messages in conversations.
+    """
+    if weekly is None:
+        weekly = build_weekly_frame(conversations)
+    weekly = weekly[weekly["user_messages"] > 0]
+    return to_points(weekly["cumulative_words"].astype("int64"))
+
+
+def generate_messages_per_chat_data(
+    conversations: List[Conversation], weekly: Optional[pd.DataFrame] = None
+) -> list[dict]:
+    if weekly is None:
+        weekly = build_weekly_frame(conversations)
+    weekly = weekly[weekly["message_count"] > 0]
+    return to_points(weekly["avg_messages"])
+
+
+def generate_messages_per_week_data(
+    conversations: List[Conversation], weekly: Optional[pd.DataFrame] = None
+) -> list[dict]:
+    if weekly is None:
+        weekly = build_weekly_frame(conversations)
+    weekly = weekly[weekly["message_count"] > 0]
+    return to_points(weekly["message_count"].astype("int64"))
+
+
+def generate_new_chats_per_week_data(
+    conversations: List[Conversation], weekly: Optional[pd.DataFrame] = None
+) -> list[dict]:
+    if weekly is None:
+        weekly = build_weekly_frame(conversations)
+    weekly = weekly[weekly["new_chats"] > 0]
+    return to_points(weekly["new_chats"].astype("int64"))
@@ -0,0 +1,194 @@
+"""
+Shared, lazily constructed API clients.
+
+Nothing here is created ( or even imported ) until the first request needs it, so importing kura doesn't require credentials and every model that uses the default client shares a single instance.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Any, Optional, TypeVar
+
+from pydantic import BaseModel
+
+from kura import metrics
+from kura.cache import DiskCache
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    import instructor
+    import jinja2
+
+    from kura.rate_limit import AdaptiveRateLimiter
+
+T = TypeVar("T", bound=BaseModel)
+
+
+@lru_cache(maxsize=None)
+def load_environment() -> None:
+    from dotenv import load_dotenv, find_dotenv
+
+    load_dotenv(find_dotenv())
+
+
+@lru_cache(maxsize=None)
+def get_openai_client() -> "AsyncOpenAI":
+    from openai import AsyncOpenAI
+
+    load_environment()
+    return AsyncOpenAI(
+        api_key=os.environ["OPENAI_API_KEY"], base_url=os.environ["OPENAI_API_BASE"]
+    )
+
+
+@lru_cache(maxsize=None)
+def get_instructor_openai_client() -> "instructor.AsyncInstructor":
+    import instructor
+
+    return instructor.from_openai(get_openai_client())
+
+
+@lru_cache(maxsize=None)
+def get_gemini_client(
+    model_name: str = "gemini-1.5-flash-latest",
+) -> "instructor.AsyncInstructor":
+    import instructor
+    import google.generativeai as genai
+
+    load_environment()
+    return instructor.from_gemini(genai.GenerativeModel(model_name), use_async=True)  # pyright: ignore
+
+
+@lru_cache(maxsize=256)
+def compile_template(source: str) -> "jinja2.Template":
+    import jinja2
+
+    return jinja2.Template(source)
+
+
+class CachedInstructorClient:
+    """
+    Wraps an async instructor client so that identical requests are answered from a cache on disk instead of calling the model again.
+
+    Requests are keyed on the model, the prompt after it's been rendered with its context and the JSON schema of the response model, so changing any of them is a cache miss. Entries expire after `ttl` seconds if it's set and the least recently used ones are evicted beyond `max_entries`.
+
+    >>> summary_model = SummaryModel(client=CachedInstructorClient(get_instructor_openai_client()))
+    """
+
+    def __init__(
+        self,
+        client: Optional["instructor.AsyncInstructor"] = None,
+        cache_path: str = "./.kura_cache/llm.db",
+        max_entries: Optional[int] = 100_000,
+        ttl: Optional[float] = None,
+        model_name: Optional[str] = None,
+    ):
+        self._client = client
+        # Only used when a request doesn't name its model, eg. Gemini clients where the model is part of the client
+        self.model_name = model_name
+        self.cache = DiskCache(cache_path, max_entries=max_entries, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @property
+    def client(self) -> "instructor.AsyncInstructor":
+        if self._client is None:
+            self._client = get_instructor_openai_client()
+        return self._client
+
+    def default_model_name(self) -> Optional[str]:
+        if self.model_name is None:
+            self.model_name = getattr(
+                getattr(self.client, "client", None), "model_name", None
+            )
+        return self.model_name
+
+    def cache_key(
+        self,
+        messages: list[dict],
+        response_model: type[BaseModel],
+        context: Optional[dict],
+        kwargs: dict,
+    ) -> str:
+        rendered = [
+            {
+                **message,
+                "content": compile_template(message["content"]).render(
+                    **(context or {})
+                )
+                if isinstance(message.get("content"), str)
+                else message.get("content"),
+            }
+            for message in messages
+        ]
+        # Retries don't change what a successful response looks like so they're left out of the key
+        options = {k: v for k, v in kwargs.items() if k not in ("model", "max_retries")}
+        key = json.dumps(
+            {
+                "model": kwargs.get("model") or self.default_model_name(),
+                "messages": rendered,
+                "response_model": response_model.model_json_schema(),
+                "options": options,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    async def create(
+        self,
+        messages: list[dict],
+        response_model: type[T],
+        context: Optional[dict] = None,
+        rate_limiter: Optional["AdaptiveRateLimiter"] = None,
+        estimated_tokens: int = 0,
+        **kwargs: Any,
+    ) -> T:
+        """
+        Only requests that miss the cache go through `rate_limiter`, so cached responses don't wait for a slot or use up the token budget.
+        """
+        key = self.cache_key(messages, response_model, context, kwargs)
+        # SQLite blocks so we keep it off the event loop
+        cached = await asyncio.to_thread(self.cache.get, key)
+        metrics.record_cache(
+            "llm", hits=int(cached is not None), misses=int(cached is None)
+        )
+        if cached is not None:
+            self.hits += 1
+            # Validators that depend on the context ( eg. candidate cluster names ) run again on the cached response
+            return response_model.model_validate_json(cached, context=context)
+
+        self.misses += 1
+        if rate_limiter is None:
+            resp = await self.client.chat.completions.create(
+                messages=messages,
+                response_model=response_model,
+                context=context,
+                **kwargs,
+            )
+        else:
+            resp = await rate_limiter.call(
+                self.client.chat.completions.create,
+                messages=messages,
+                response_model=response_model,
+                context=context,
+                estimated_tokens=estimated_tokens,
+                **kwargs,
+            )
+        await asyncio.to_thread(self.cache.set, key, resp.model_dump_json().encode())
+        return resp
+
+
+async def create_completion(
+    client: Any, rate_limiter: "AdaptiveRateLimiter", **kwargs: Any
+) -> Any:
+    """
+    Request a structured response from an instructor client within `rate_limiter`'s limits. Cached clients answer hits without going through the limiter at all.
+    """
+    if isinstance(client, CachedInstructorClient):
+        return await client.create(rate_limiter=rate_limiter, **kwargs)
+    return await rate_limiter.call(client.chat.completions.create, **kwargs)
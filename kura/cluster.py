@@ -1,47 +1,120 @@
 from kura.base_classes import BaseClusterModel, BaseClusteringMethod, BaseEmbeddingModel
-from kura.embedding import OpenAIEmbeddingModel
+from kura.embedding import (
+    EmbeddingInputError,
+    OpenAIEmbeddingModel,
+    embedding_model_name,
+    text_hash,
+)
+from kura.embedding_store import EmbeddingStore
+from kura.centroids import CentroidIndex
+from kura.clients import create_completion, get_gemini_client
 from kura.k_means import KmeansClusteringMethod
+from kura.rate_limit import AdaptiveRateLimiter, estimate_tokens
 from kura.types import ConversationSummary, Cluster, GeneratedCluster
 from tqdm.asyncio import tqdm_asyncio
 import numpy as np
-from asyncio import Semaphore
-import instructor
-import google.generativeai as genai
-import os
+from numpy.typing import NDArray
+from asyncio import Semaphore, to_thread
+from typing import Optional
+import math
+import random
 
 
 class ClusterModel(BaseClusterModel):
     def __init__(
         self,
-        clustering_method: BaseClusteringMethod = KmeansClusteringMethod(),
-        embedding_model: BaseEmbeddingModel = OpenAIEmbeddingModel(),
+        clustering_method: Optional[BaseClusteringMethod] = None,
+        embedding_model: Optional[BaseEmbeddingModel] = None,
         max_concurrent_requests: int = 50,
-        client=instructor.from_gemini(
-            genai.GenerativeModel("gemini-1.5-flash-latest"), use_async=True
-        ),
+        client=None,
+        embedding_store: Optional[EmbeddingStore] = None,
+        contrastive_neighbours: int = 5,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        embedding_chunk_size: int = 10_000,
     ):
-        self.clustering_method = clustering_method
-        self.embedding_model = embedding_model
+        self.clustering_method = clustering_method or KmeansClusteringMethod()
+        self.embedding_model = embedding_model or OpenAIEmbeddingModel()
         self.max_concurrent_requests = max_concurrent_requests
-        self.client = client
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter(
+            max_concurrency=max_concurrent_requests
+        )
+        self._client = client
+        self.embedding_store = embedding_store
+        if self.embedding_store is not None:
+            self.embedding_store.check_model(embedding_model_name(self.embedding_model))
+        # With an embedding store we embed and write this many summaries at a time so that a cold run never holds every embedding in memory
+        self.embedding_chunk_size = embedding_chunk_size
+        self.contrastive_neighbours = contrastive_neighbours
+        self.centroid_index: Optional[CentroidIndex] = None
+
+    @property
+    def client(self):
+        # The default Gemini client is created on the first request and shared between models
+        if self._client is None:
+            self._client = get_gemini_client()
+        return self._client
 
     def get_contrastive_examples(
         self,
         cluster_id: int,
         cluster_id_to_summaries: dict[int, list[ConversationSummary]],
         desired_count: int = 10,
+        neighbour_ids: Optional[list[int]] = None,
     ):
-        other_clusters = [c for c in cluster_id_to_summaries.keys() if c != cluster_id]
-        all_examples = []
-        for cluster in other_clusters:
-            all_examples.extend(cluster_id_to_summaries[cluster])
+        """
+        Pick contrastive examples for a cluster from the clusters in `neighbour_ids` ( ordered from nearest to furthest ).
+
+        We draw an even share from each neighbour so the cost only depends on `desired_count`. When no neighbours are given we fall back to sampling from every other cluster.
+
+        Sampling is seeded from the cluster's chat ids so the same cluster always gets the same examples, which keeps its prompt ( and so its cached response ) the same across runs.
+        """
+        rng = random.Random(
+            text_hash(
+                "\0".join(
+                    sorted(item.chat_id for item in cluster_id_to_summaries[cluster_id])
+                )
+            )
+        )
+        if neighbour_ids is None:
+            other_clusters = [
+                c for c in cluster_id_to_summaries.keys() if c != cluster_id
+            ]
+            all_examples = []
+            for cluster in other_clusters:
+                all_examples.extend(cluster_id_to_summaries[cluster])
 
-        # If we don't have enough examples, return all of them
-        if len(all_examples) <= desired_count:
-            return all_examples
+            # If we don't have enough examples, return all of them
+            if len(all_examples) <= desired_count:
+                return all_examples
 
-        # Otherwise sample without replacement
-        return list(np.random.choice(all_examples, size=desired_count, replace=False))
+            # Otherwise sample without replacement
+            return rng.sample(all_examples, desired_count)
+
+        examples: list[ConversationSummary] = []
+        per_neighbour = math.ceil(desired_count / max(len(neighbour_ids), 1))
+        for neighbour_id in neighbour_ids:
+            neighbour = cluster_id_to_summaries[neighbour_id]
+            count = min(per_neighbour, len(neighbour), desired_count - len(examples))
+            examples.extend(rng.sample(neighbour, count))
+            if len(examples) >= desired_count:
+                break
+        return examples
+
+    def build_centroid_index(
+        self,
+        embeddings: NDArray[np.float32],
+        summaries: list[ConversationSummary],
+        cluster_id_to_summaries: dict[int, list[ConversationSummary]],
+    ) -> CentroidIndex:
+        row = {item.chat_id: i for i, item in enumerate(summaries)}
+        return CentroidIndex.from_groups(
+            ids=[str(cluster_id) for cluster_id in cluster_id_to_summaries],
+            embeddings=embeddings,
+            groups=[
+                np.array([row[item.chat_id] for item in items], dtype=np.int64)
+                for items in cluster_id_to_summaries.values()
+            ],
+        )
 
     async def generate_cluster(
         self,
@@ -50,7 +123,9 @@ class ClusterModel(BaseClusterModel):
         sem: Semaphore,
     ) -> Cluster:
         async with sem:
-            resp = await self.client.chat.completions.create(
+            resp = await create_completion(
+                self.client,
+                self.rate_limiter,
                 messages=[
                     # {
                     #     "role": "system",
@@ -98,6 +173,10 @@ class ClusterModel(BaseClusterModel):
                     },
                 ],
                 response_model=GeneratedCluster,
+                estimated_tokens=estimate_tokens(
+                    *[item.summary for item in summaries + contrastive_examples]
+                )
+                + 500,
                 context={
                     "positive_examples": summaries,
                     "contrastive_examples": contrastive_examples,
@@ -111,38 +190,88 @@ class ClusterModel(BaseClusterModel):
                 parent_id=None,
             )
 
+    async def embed_summaries(
+        self, summaries: list[ConversationSummary], sem: Semaphore
+    ) -> NDArray[np.float32]:
+        """
+        Embed the summaries into an (n, dim) float32 matrix.
+
+        When we have an embedding store we only embed the summaries that aren't in it yet ( or whose text has changed ) and read the rest back from the memory map.
+        """
+        if self.embedding_store is None:
+            return np.asarray(
+                await self._embed(summaries, sem),
+                dtype=np.float32,
+            )
+
+        hashes = {item.chat_id: text_hash(item.summary) for item in summaries}
+        stale = set(
+            self.embedding_store.missing(list(hashes), list(hashes.values()))
+        )
+        missing = [item for item in summaries if item.chat_id in stale]
+        for i in range(0, len(missing), self.embedding_chunk_size):
+            # Each chunk is on disk before we embed the next so an interrupted run keeps what it has embedded
+            chunk = missing[i : i + self.embedding_chunk_size]
+            self.embedding_store.append(
+                [item.chat_id for item in chunk],
+                await self._embed(chunk, sem),
+                [hashes[item.chat_id] for item in chunk],
+            )
+        return self.embedding_store.get([item.chat_id for item in summaries])
+
+    async def _embed(
+        self, summaries: list[ConversationSummary], sem: Semaphore
+    ) -> list[list[float]]:
+        try:
+            return await self.embedding_model.embed_batch(
+                [item.summary for item in summaries], sem, desc="Embedding Summaries"
+            )
+        except EmbeddingInputError as e:
+            raise ValueError(
+                f"Couldn't embed the summary of conversation {summaries[e.index].chat_id}"
+            ) from e
+
     async def cluster_summaries(
         self, summaries: list[ConversationSummary]
     ) -> list[Cluster]:
         sem = Semaphore(self.max_concurrent_requests)
-        embeddings: list[list[float]] = await tqdm_asyncio.gather(
-            *[
-                self.embedding_model.embed(text=item.summary, sem=sem)
-                for item in summaries
-            ],
-            desc="Embedding Summaries",
+        embeddings = await self.embed_summaries(summaries, sem)
+        # Clustering is CPU bound so we run it in a thread to keep the event loop responsive
+        cluster_id_to_summaries = await to_thread(
+            self.clustering_method.cluster_embeddings, embeddings, summaries
         )
-        cluster_id_to_summaries = self.clustering_method.cluster(
-            [
-                {
-                    "item": item,
-                    "embedding": embedding,
-                }
-                for item, embedding in zip(summaries, embeddings)
-            ]
+
+        # Contrastive examples come from the clusters whose centroids are closest to each cluster
+        centroid_index = self.build_centroid_index(
+            embeddings, summaries, cluster_id_to_summaries
         )
+        cluster_ids = list(cluster_id_to_summaries.keys())
+        neighbours = centroid_index.neighbours(self.contrastive_neighbours)
+
         clusters: list[Cluster] = await tqdm_asyncio.gather(
             *[
                 self.generate_cluster(
                     summaries,
                     self.get_contrastive_examples(
-                        cluster_id, cluster_id_to_summaries, 10
+                        cluster_id,
+                        cluster_id_to_summaries,
+                        10,
+                        [cluster_ids[j] for j in neighbours[i]],
                     ),
                     sem,
                 )
-                for cluster_id, summaries in cluster_id_to_summaries.items()
+                for i, (cluster_id, summaries) in enumerate(
+                    cluster_id_to_summaries.items()
+                )
             ],
             desc="Generating Base Clusters",
         )
 
+        # Keep the centroids around, keyed by the generated cluster ids, so new conversations can be assigned to these clusters later
+        self.centroid_index = CentroidIndex(
+            ids=[cluster.id for cluster in clusters],
+            centroids=centroid_index.centroids,
+            counts=centroid_index.counts,
+            embedding_model=embedding_model_name(self.embedding_model),
+        )
         return clusters
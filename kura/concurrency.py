@@ -0,0 +1,69 @@
+import asyncio
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, TypeVar, Union
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+async def _iterate(items: Union[Iterable[T], AsyncIterable[T]]) -> AsyncIterator[T]:
+    if isinstance(items, AsyncIterable):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def bounded_map(
+    fn: Callable[[T], Awaitable[R]],
+    items: Union[Iterable[T], AsyncIterable[T]],
+    max_concurrency: int,
+) -> AsyncIterator[R]:
+    """
+    Apply `fn` to every item while keeping at most `max_concurrency` calls in flight, yielding results in the order they complete.
+
+    Unlike gathering fixed slices of items, a new call is started as soon as any call finishes so a single slow call never stalls the rest of the window. Items are pulled lazily so `items` can be a generator or an async iterator of unknown length.
+
+    If any call raises, the remaining calls are cancelled and the exception propagates to the consumer.
+    """
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency must be at least 1")
+
+    pending: set[asyncio.Task[R]] = set()
+    try:
+        async for item in _iterate(items):
+            if len(pending) >= max_concurrency:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+            pending.add(asyncio.ensure_future(fn(item)))
+
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def gather_or_cancel(*aws: Awaitable[T]) -> list[T]:
+    """
+    Like `asyncio.gather` except that as soon as one awaitable raises the others are cancelled and the exception propagates.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in tasks:
+            if task.done() and not task.cancelled() and task.exception() is not None:
+                raise task.exception()  # type: ignore[misc]
+        return [task.result() for task in tasks]
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Wait for the cancelled tasks to finish and retrieve every other exception so that none of them are reported as never retrieved
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,141 @@
+"""
+Group conversations that are exact or near duplicates of each other so that only one of them has to be summarised.
+
+Exact duplicates share a hash of their normalised messages. Near duplicates ( eg. the same templated request with a few values swapped out ) are found with MinHash signatures over word shingles, bucketed with locality sensitive hashing so we only compare conversations that are likely to be similar, and then confirmed by their estimated Jaccard similarity.
+"""
+
+import hashlib
+import re
+import zlib
+from itertools import combinations
+from typing import Optional
+
+import numpy as np
+
+from kura.types import Conversation
+
+WHITESPACE = re.compile(r"\s+")
+MAX_HASH = np.uint64(2**32 - 1)
+
+
+def normalise(text: str) -> str:
+    return WHITESPACE.sub(" ", text).strip().lower()
+
+
+def content_hash(conversation: Conversation) -> str:
+    digest = hashlib.sha256()
+    for message in conversation.messages:
+        digest.update(f"{message.role}\0{normalise(message.content)}\0".encode())
+    return digest.hexdigest()
+
+
+class UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            # The earlier conversation always ends up as the root so it's the one we summarise
+            self.parent[max(i, j)] = min(i, j)
+
+
+class ConversationDeduplicator:
+    def __init__(
+        self,
+        threshold: Optional[float] = None,
+        num_perm: int = 128,
+        bands: int = 16,
+        shingle_size: int = 3,
+        seed: int = 0,
+    ):
+        """
+        By default we only group exact duplicates. Set `threshold` ( eg. 0.85 ) to also treat conversations whose estimated Jaccard similarity is at least `threshold` as duplicates, bear in mind that conversations from the same template that only differ in their specifics will then share a summary.
+
+        `num_perm` must be divisible by `bands`. More bands find more candidate pairs at the cost of comparing more of them.
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing, `a` has to be odd for each permutation to be a bijection
+        self.a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+
+    def shingles(self, conversation: Conversation) -> np.ndarray:
+        words = normalise(
+            " ".join(message.content for message in conversation.messages)
+        ).split(" ")
+        n = self.shingle_size
+        grams = {
+            " ".join(words[i : i + n]) for i in range(max(len(words) - n + 1, 1))
+        }
+        return np.fromiter(
+            (zlib.crc32(gram.encode()) for gram in grams),
+            dtype=np.uint64,
+            count=len(grams),
+        )
+
+    def signature(self, conversation: Conversation) -> np.ndarray:
+        shingles = self.shingles(conversation)
+        if not shingles.size:
+            return np.full(self.num_perm, MAX_HASH)
+        # Products wrap around modulo 2**64 and we keep the top 32 bits
+        with np.errstate(over="ignore"):
+            hashed = self.a[:, None] * shingles[None, :] + self.b[:, None]
+        return (hashed >> np.uint64(32)).min(axis=1)
+
+    def group(
+        self, conversations: list[Conversation]
+    ) -> dict[str, list[Conversation]]:
+        """
+        Map the chat_id of a representative conversation to every conversation in its group, including itself.
+
+        Representatives are the first conversation of each group in the order they were passed in.
+        """
+        groups = UnionFind(len(conversations))
+
+        first_seen: dict[str, int] = {}
+        for i, conversation in enumerate(conversations):
+            groups.union(first_seen.setdefault(content_hash(conversation), i), i)
+
+        if self.threshold is not None:
+            # Exact duplicates have the same signature so we only need one per group
+            unique = [i for i in range(len(conversations)) if groups.find(i) == i]
+            signatures = np.array(
+                [self.signature(conversations[i]) for i in unique], dtype=np.uint64
+            ).reshape(len(unique), self.num_perm)
+
+            rows = self.num_perm // self.bands
+            for band in range(self.bands):
+                buckets: dict[bytes, list[int]] = {}
+                for position, band_hash in enumerate(
+                    signatures[:, band * rows : (band + 1) * rows]
+                ):
+                    buckets.setdefault(band_hash.tobytes(), []).append(position)
+
+                for members in buckets.values():
+                    # Every pair in a bucket is a candidate, two members can be similar to each other while both being far from the first one
+                    for a, b in combinations(members, 2):
+                        first, second = unique[a], unique[b]
+                        if groups.find(first) == groups.find(second):
+                            continue
+                        similarity = np.mean(signatures[a] == signatures[b])
+                        if similarity >= self.threshold:
+                            groups.union(first, second)
+
+        result: dict[str, list[Conversation]] = {}
+        for i, conversation in enumerate(conversations):
+            representative = conversations[groups.find(i)].chat_id
+            result.setdefault(representative, []).append(conversation)
+        return result
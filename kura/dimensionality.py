@@ -1,37 +1,75 @@
 from kura.base_classes import BaseDimensionalityReduction, BaseEmbeddingModel
 from kura.types import Cluster, ProjectedCluster
-from kura.embedding import OpenAIEmbeddingModel
-from umap import UMAP
+from kura.embedding import OpenAIEmbeddingModel, cluster_text, cluster_text_hash
+from typing import TYPE_CHECKING, Optional
 import numpy as np
 import asyncio
 import os
 from numpy.typing import NDArray
 from numpy import float64
 
+if TYPE_CHECKING:
+    from umap import UMAP
+
 
 class HDBUMAP(BaseDimensionalityReduction):
     def __init__(
         self,
-        embedding_model: BaseEmbeddingModel = OpenAIEmbeddingModel(),
+        embedding_model: Optional[BaseEmbeddingModel] = None,
+        cluster_embeddings: Optional[dict[str, list[float]]] = None,
+        projection_path: Optional[str] = None,
+        refit_threshold: float = 0.5,
     ):
-        self.embedding_model = embedding_model
+        """
+        `cluster_embeddings` is a table of `cluster_text_hash` to embedding computed by an earlier stage ( eg. `MetaClusterModel.cluster_embeddings` ), we only embed clusters that aren't in it.
 
-    async def reduce_dimensionality(
-        self, clusters: list[Cluster]
-    ) -> list[ProjectedCluster]:
-        # Embed all clusters
-        sem = asyncio.Semaphore(50)
-        cluster_embeddings = await asyncio.gather(
-            *[
-                self.embedding_model.embed(
-                    f"Name: {c.name}\nDescription: {c.description}", sem
-                )
-                for c in clusters
-            ]
+        When `projection_path` is set we persist the fitted UMAP model there along with the coordinates of every cluster we projected. On later runs clusters whose name and description haven't changed keep their coordinates and the rest are placed with `transform`, we only refit from scratch when more than `refit_threshold` of the clusters are new.
+        """
+        self.embedding_model = embedding_model or OpenAIEmbeddingModel()
+        self.cluster_embeddings = (
+            cluster_embeddings if cluster_embeddings is not None else {}
+        )
+        self.projection_path = projection_path
+        self.refit_threshold = refit_threshold
+
+    async def embed_clusters(self, clusters: list[Cluster]) -> NDArray[np.float32]:
+        keys = [cluster_text_hash(c) for c in clusters]
+        missing = {
+            key: cluster_text(c)
+            for key, c in zip(keys, clusters)
+            if key not in self.cluster_embeddings
+        }
+        if missing:
+            sem = asyncio.Semaphore(50)
+            embeddings = await self.embedding_model.embed_batch(
+                list(missing.values()), sem
+            )
+            self.cluster_embeddings.update(zip(missing, embeddings))
+        return np.asarray(
+            [self.cluster_embeddings[key] for key in keys], dtype=np.float32
+        )
+
+    def save_projection(
+        self, reducer: "UMAP", clusters: list[Cluster], coords: NDArray
+    ) -> None:
+        if self.projection_path is None:
+            return
+
+        import joblib
+
+        joblib.dump(
+            {
+                "reducer": reducer,
+                "positions": {
+                    cluster_text_hash(c): coords[i] for i, c in enumerate(clusters)
+                },
+            },
+            self.projection_path,
         )
 
-        # Convert embeddings to numpy array
-        embeddings = np.array(cluster_embeddings)
+    def fit(self, embeddings: NDArray[np.float32], clusters: list[Cluster]) -> NDArray:
+        # umap pulls in numba which takes seconds to import so we only load it once we need it
+        from umap import UMAP
 
         # Project to 2D using UMAP
         umap_reducer = UMAP(
@@ -41,6 +79,50 @@ class HDBUMAP(BaseDimensionalityReduction):
             metric="cosine",
         )
         reduced_embeddings = umap_reducer.fit_transform(embeddings)
+        self.save_projection(umap_reducer, clusters, reduced_embeddings)  # pyright: ignore
+        return reduced_embeddings  # pyright: ignore
+
+    def project(
+        self, embeddings: NDArray[np.float32], clusters: list[Cluster]
+    ) -> NDArray:
+        """
+        Reuse the persisted projection when most of the clusters were projected before, otherwise fit a new one
+        """
+        if self.projection_path is None or not os.path.exists(self.projection_path):
+            return self.fit(embeddings, clusters)
+
+        import joblib
+
+        fitted = joblib.load(self.projection_path)
+        positions: dict[str, NDArray] = fitted.get("positions", {})
+        keys = [cluster_text_hash(c) for c in clusters]
+        unchanged = np.array([key in positions for key in keys], dtype=bool)
+
+        if (~unchanged).sum() > self.refit_threshold * len(clusters):
+            return self.fit(embeddings, clusters)
+
+        print(
+            f"Reusing projection from {self.projection_path} for {unchanged.sum()} clusters, transforming {(~unchanged).sum()} new clusters"
+        )
+        reducer: "UMAP" = fitted["reducer"]
+        reduced_embeddings = np.empty((len(clusters), 2), dtype=np.float32)
+        if unchanged.any():
+            reduced_embeddings[unchanged] = [
+                positions[key] for key, keep in zip(keys, unchanged) if keep
+            ]
+        if (~unchanged).any():
+            reduced_embeddings[~unchanged] = reducer.transform(embeddings[~unchanged])
+            # Transformed clusters keep their coordinates on the next run too rather than being transformed again
+            self.save_projection(reducer, clusters, reduced_embeddings)
+        return reduced_embeddings
+
+    async def reduce_dimensionality(
+        self, clusters: list[Cluster]
+    ) -> list[ProjectedCluster]:
+        # Embed all clusters, reusing any embeddings computed upstream
+        embeddings = await self.embed_clusters(clusters)
+
+        reduced_embeddings = self.project(embeddings, clusters)
 
         # Create projected clusters with 2D coordinates
         res = []
@@ -1,24 +1,239 @@
 from kura.base_classes import BaseEmbeddingModel
-from asyncio import Semaphore, wait_for
-from tenacity import retry, wait_fixed, stop_after_attempt
-from openai import AsyncOpenAI
-import os
-from dotenv import load_dotenv, find_dotenv
+from kura.cache import DiskCache
+from kura import metrics
+from kura.clients import get_openai_client
+from kura.concurrency import gather_or_cancel
+from kura.types import Cluster
+from kura.rate_limit import (
+    AdaptiveRateLimiter,
+    estimate_tokens,
+    is_input_error,
+)
+from asyncio import Semaphore, to_thread, wait_for
+from tqdm.auto import tqdm
+from typing import TYPE_CHECKING, Optional
+import hashlib
+import numpy as np
 
-load_dotenv(find_dotenv())
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+
+class EmbeddingInputError(ValueError):
+    """Raised when a single input can't be embedded, `index` is its position in the texts passed to `embed_batch`"""
+
+    def __init__(self, index: int, text: str):
+        super().__init__(f"Couldn't embed input {index}: {text[:100]!r}")
+        self.index = index
+        self.text = text
 
 
 class OpenAIEmbeddingModel(BaseEmbeddingModel):
-    def __init__(self):
-        self.client = AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"], base_url=os.environ["OPENAI_API_BASE"])
+    def __init__(
+        self,
+        model_name: str = "text-embedding-3-small-eastus",
+        batch_size: int = 2048,
+        max_tokens_per_batch: int = 100_000,
+        batch_timeout: int = 60,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        client: Optional["AsyncOpenAI"] = None,
+    ):
+        self._client = client
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.batch_timeout = batch_timeout
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter()
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        # We only create the client on the first request so that constructing the model doesn't need credentials
+        if self._client is None:
+            self._client = get_openai_client()
+        return self._client
+
+    async def _create(self, input, timeout: int):
+        return await wait_for(
+            self.client.embeddings.create(input=input, model=self.model_name),
+            timeout=timeout,
+        )
 
-    @retry(wait=wait_fixed(3), stop=stop_after_attempt(3))
     async def embed(self, text: str, sem: Semaphore) -> list[float]:
         async with sem:
-            resp = await wait_for(
-                self.client.embeddings.create(
-                    input=text, model="text-embedding-3-small-eastus"
-                ),
-                timeout=5,
+            resp = await self.rate_limiter.call(
+                self._create,
+                text,
+                5,
+                estimated_tokens=estimate_tokens(text),
+                request_kind="embedding",
             )
             return resp.data[0].embedding
+
+    def estimate_tokens(self, text: str) -> int:
+        return estimate_tokens(text)
+
+    def pack_batches(self, texts: list[str]) -> list[list[int]]:
+        """
+        Group the indices of `texts` into batches that respect both the maximum number of inputs per request and the token budget of a single request.
+        """
+        batches: list[list[int]] = []
+        current: list[int] = []
+        current_tokens = 0
+        for i, text in enumerate(texts):
+            tokens = self.estimate_tokens(text)
+            if current and (
+                len(current) >= self.batch_size
+                or current_tokens + tokens > self.max_tokens_per_batch
+            ):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(i)
+            current_tokens += tokens
+
+        if current:
+            batches.append(current)
+        return batches
+
+    async def _embed_request(
+        self, texts: list[str], sem: Semaphore, max_retries: Optional[int] = None
+    ) -> list[list[float]]:
+        async with sem:
+            resp = await self.rate_limiter.call(
+                self._create,
+                texts,
+                self.batch_timeout,
+                estimated_tokens=estimate_tokens(*texts),
+                request_kind="embedding",
+                max_retries=max_retries,
+            )
+            return [item.embedding for item in sorted(resp.data, key=lambda x: x.index)]
+
+    async def _embed_with_split(
+        self, texts: list[str], indices: list[int], sem: Semaphore
+    ) -> list[list[float]]:
+        try:
+            return await self._embed_request([texts[i] for i in indices], sem)
+        except Exception as e:
+            # Only a rejected input is worth looking for, auth errors, a wrong model name or errors the rate limiter has already retried would fail every smaller request too
+            if not is_input_error(e):
+                raise
+            return await self._bisect(texts, indices, sem, e)
+
+    async def _bisect(
+        self, texts: list[str], indices: list[int], sem: Semaphore, error: Exception
+    ) -> list[list[float]]:
+        """
+        A single bad input fails the whole batch so we split it in half until we isolate the input, without retrying any of the smaller requests.
+        """
+        if len(indices) == 1:
+            raise EmbeddingInputError(indices[0], texts[indices[0]]) from error
+
+        async def half(part: list[int]) -> list[list[float]]:
+            try:
+                return await self._embed_request(
+                    [texts[i] for i in part], sem, max_retries=0
+                )
+            except Exception as e:
+                if not is_input_error(e):
+                    raise
+                return await self._bisect(texts, part, sem, e)
+
+        mid = len(indices) // 2
+        left, right = await gather_or_cancel(half(indices[:mid]), half(indices[mid:]))
+        return left + right
+
+    async def embed_batch(
+        self, texts: list[str], sem: Semaphore, desc: Optional[str] = None
+    ) -> list[list[float]]:
+        if not texts:
+            return []
+
+        batches = self.pack_batches(texts)
+        embeddings: list[list[float]] = [[] for _ in texts]
+        with tqdm(total=len(texts), desc=desc, disable=desc is None) as pbar:
+
+            async def embed(batch: list[int]) -> None:
+                for i, embedding in zip(
+                    batch, await self._embed_with_split(texts, batch, sem)
+                ):
+                    embeddings[i] = embedding
+                pbar.update(len(batch))
+
+            # An input that can't be embedded fails the whole call so there's no point finishing the other batches
+            await gather_or_cancel(*[embed(batch) for batch in batches])
+        return embeddings
+
+
+def embedding_model_name(embedding_model: BaseEmbeddingModel) -> str:
+    return getattr(embedding_model, "model_name", type(embedding_model).__name__)
+
+
+def cluster_text(cluster: Cluster) -> str:
+    """The text we embed for a cluster"""
+    return f"Name: {cluster.name}\nDescription: {cluster.description}"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def cluster_text_hash(cluster: Cluster) -> str:
+    # Cluster ids are regenerated on every run and a cluster can be renamed without changing its id, so embeddings of clusters are keyed on what was embedded
+    return text_hash(cluster_text(cluster))
+
+
+class CachedEmbeddingModel(BaseEmbeddingModel):
+    """
+    Wraps any embedding model with a persistent cache keyed by the embedding model and a hash of the text.
+
+    Point every stage of the pipeline at the same `cache_path` ( or the same instance ) so that re-runs and overlapping datasets only pay for texts we haven't seen before.
+    """
+
+    def __init__(
+        self,
+        embedding_model: BaseEmbeddingModel,
+        cache_path: str = "./.kura_cache/embeddings.db",
+        max_entries: Optional[int] = 1_000_000,
+    ):
+        self.embedding_model = embedding_model
+        self.model_name = embedding_model_name(embedding_model)
+        self.cache = DiskCache(cache_path, max_entries=max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def cache_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode()).hexdigest()
+
+    async def embed(self, text: str, sem: Semaphore) -> list[float]:
+        return (await self.embed_batch([text], sem))[0]
+
+    async def embed_batch(
+        self, texts: list[str], sem: Semaphore, desc: Optional[str] = None
+    ) -> list[list[float]]:
+        keys = [self.cache_key(text) for text in texts]
+        # Identical texts within the same call are only looked up, counted and embedded once
+        unique = dict(zip(keys, texts))
+        # SQLite blocks so we keep it off the event loop
+        values = await to_thread(self.cache.get_many, list(unique))
+        missing = {key: text for key, text in unique.items() if key not in values}
+
+        self.hits += len(unique) - len(missing)
+        self.misses += len(missing)
+        metrics.record_cache(
+            "embedding", hits=len(unique) - len(missing), misses=len(missing)
+        )
+
+        if missing:
+            embeddings = await self.embedding_model.embed_batch(
+                list(missing.values()), sem, desc=desc
+            )
+            computed = {
+                key: np.asarray(embedding, dtype=np.float32).tobytes()
+                for key, embedding in zip(missing, embeddings)
+            }
+            await to_thread(self.cache.set_many, computed)
+            values.update(computed)
+
+        # Fresh embeddings go through float32 too so that a text embeds to the same values whether or not it was cached
+        return [np.frombuffer(values[key], dtype=np.float32).tolist() for key in keys]
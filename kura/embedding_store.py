@@ -0,0 +1,217 @@
+import json
+import os
+from typing import Optional, Sequence, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+class EmbeddingStore:
+    """
+    An append-only store of float32 embeddings backed by a memory-mapped matrix on disk.
+
+    The store lives in a directory containing
+
+    - `embeddings.f32` : the raw row-major float32 matrix
+    - `ids.txt` : one id per line, optionally followed by a tab and a hash of the embedded text. The first line for an id gives its row, later lines record the text hash of an overwritten row
+    - `meta.json` : the dimension of the embeddings and the model that produced them
+
+    Rows are only ever paged in when they're read so we can hold millions of embeddings without materialising them as Python floats.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dim: Optional[int] = None,
+        initial_capacity: int = 1024,
+        model: Optional[str] = None,
+    ):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.data_path = os.path.join(path, "embeddings.f32")
+        self.ids_path = os.path.join(path, "ids.txt")
+        self.meta_path = os.path.join(path, "meta.json")
+        self.initial_capacity = initial_capacity
+
+        self.model: Optional[str] = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+            stored_dim = meta["dim"]
+            if dim is not None and dim != stored_dim:
+                raise ValueError(
+                    f"Embedding store at {path} has dimension {stored_dim}, got {dim}"
+                )
+            dim = stored_dim
+            self.model = meta.get("model")
+
+        self.dim: Optional[int] = dim
+        self.ids: list[str] = []
+        self.id_to_row: dict[str, int] = {}
+        self.text_hashes: dict[str, str] = {}
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, "r") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    id, _, text_hash = line.rstrip("\n").partition("\t")
+                    if id not in self.id_to_row:
+                        self.id_to_row[id] = len(self.ids)
+                        self.ids.append(id)
+                    if text_hash:
+                        self.text_hashes[id] = text_hash
+                    else:
+                        self.text_hashes.pop(id, None)
+
+        if model is not None:
+            self.check_model(model)
+
+        self._mmap: Optional[np.memmap] = None
+        if (
+            self.dim is not None
+            and os.path.exists(self.data_path)
+            and os.path.getsize(self.data_path) > 0
+        ):
+            self._open()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self.id_to_row
+
+    def check_model(self, model: str) -> None:
+        """
+        Record the embedding model that fills this store, embeddings from different models aren't comparable so we refuse to mix them
+        """
+        if self.model is None:
+            self.model = model
+            if self.dim is not None:
+                self._write_meta()
+        elif self.model != model:
+            raise ValueError(
+                f"Embedding store at {self.path} holds embeddings from {self.model}, not {model}. Use a new path or delete the store to re-embed"
+            )
+
+    def _write_meta(self) -> None:
+        with open(self.meta_path, "w") as f:
+            json.dump({"dim": self.dim, "model": self.model}, f)
+
+    @property
+    def capacity(self) -> int:
+        return 0 if self._mmap is None else self._mmap.shape[0]
+
+    def _open(self) -> None:
+        assert self.dim is not None
+        row_bytes = self.dim * np.dtype(np.float32).itemsize
+        rows = os.path.getsize(self.data_path) // row_bytes
+        self._mmap = np.memmap(
+            self.data_path, dtype=np.float32, mode="r+", shape=(rows, self.dim)
+        )
+
+    def _reserve(self, rows: int) -> None:
+        if rows <= self.capacity:
+            return
+
+        assert self.dim is not None
+        new_capacity = max(rows, self.capacity * 2, self.initial_capacity)
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap = None
+
+        with open(self.data_path, "ab") as f:
+            f.truncate(new_capacity * self.dim * np.dtype(np.float32).itemsize)
+        self._open()
+
+    def append(
+        self,
+        ids: Sequence[str],
+        embeddings: Union[NDArray, list[list[float]]],
+        text_hashes: Optional[Sequence[str]] = None,
+    ) -> None:
+        """
+        Add embeddings for `ids`, overwriting the rows of ids that are already in the store.
+
+        Pass the hash of each embedded text as `text_hashes` so that `missing` can tell when an id's text has changed.
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if len(ids) == 0:
+            return
+        if vectors.ndim != 2 or vectors.shape[0] != len(ids):
+            raise ValueError(
+                f"Expected {len(ids)} embeddings, got an array of shape {vectors.shape}"
+            )
+
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._write_meta()
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(
+                f"Expected embeddings of dimension {self.dim}, got {vectors.shape[1]}"
+            )
+
+        if text_hashes is not None and len(text_hashes) != len(ids):
+            raise ValueError(f"Expected {len(ids)} text hashes, got {len(text_hashes)}")
+
+        new_ids = []
+        rows = []
+        for id in ids:
+            if id not in self.id_to_row:
+                self.id_to_row[id] = len(self.ids) + len(new_ids)
+                new_ids.append(id)
+            rows.append(self.id_to_row[id])
+
+        self._reserve(len(self.ids) + len(new_ids))
+        assert self._mmap is not None
+        self._mmap[np.asarray(rows)] = vectors
+        self._mmap.flush()
+
+        # We only record the ids once their rows are on disk so a crash never leaves an id pointing at garbage. Overwritten rows get a new line too so that their text hash is updated
+        with open(self.ids_path, "a") as f:
+            for i, id in enumerate(ids):
+                text_hash = text_hashes[i] if text_hashes is not None else ""
+                f.write(f"{id}\t{text_hash}\n" if text_hash else f"{id}\n")
+                if text_hash:
+                    self.text_hashes[id] = text_hash
+                else:
+                    self.text_hashes.pop(id, None)
+        self.ids.extend(new_ids)
+
+    @property
+    def matrix(self) -> NDArray[np.float32]:
+        """A zero-copy view over every embedding in the store, in insertion order"""
+        if self._mmap is None:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return self._mmap[: len(self.ids)]
+
+    def rows(self, ids: Sequence[str]) -> NDArray[np.int64]:
+        return np.fromiter(
+            (self.id_to_row[id] for id in ids), dtype=np.int64, count=len(ids)
+        )
+
+    def get(self, ids: Sequence[str]) -> NDArray[np.float32]:
+        """
+        Return the embeddings for `ids` as an (n, dim) float32 array.
+
+        When the ids are a contiguous run of rows ( eg. everything we appended in one go ) this is a view over the memory map rather than a copy.
+        """
+        rows = self.rows(ids)
+        if len(rows) == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+
+        start = int(rows[0])
+        if np.array_equal(rows, np.arange(start, start + len(rows))):
+            return self.matrix[start : start + len(rows)]
+        return self.matrix[rows]
+
+    def missing(
+        self, ids: Sequence[str], text_hashes: Optional[Sequence[str]] = None
+    ) -> list[str]:
+        """Ids that aren't in the store, or whose text hash differs from the one in `text_hashes`"""
+        if text_hashes is None:
+            return [id for id in ids if id not in self.id_to_row]
+        return [
+            id
+            for id, text_hash in zip(ids, text_hashes)
+            if id not in self.id_to_row or self.text_hashes.get(id) != text_hash
+        ]
@@ -1,15 +1,42 @@
 from kura.base_classes import BaseClusteringMethod
-from sklearn.cluster import KMeans
 import math
-from typing import TypeVar
+from typing import TYPE_CHECKING, Literal, Optional, TypeVar, Union
 import numpy as np
+from numpy.typing import NDArray
+
+if TYPE_CHECKING:
+    from sklearn.cluster import KMeans, MiniBatchKMeans
 
 T = TypeVar("T")
 
 
 class KmeansClusteringMethod(BaseClusteringMethod):
-    def __init__(self, clusters_per_group: int = 10):
+    def __init__(
+        self,
+        clusters_per_group: int = 10,
+        mode: Literal["full", "minibatch", "sample"] = "full",
+        max_memory_mb: int = 1024,
+        batch_size: int = 4096,
+        sample_size: Optional[int] = None,
+        random_state: Optional[int] = 0,
+    ):
+        """
+        `mode` controls how we fit the clusters
+
+        - "full" : fit `KMeans` on every embedding
+        - "minibatch" : fit `MiniBatchKMeans` with batches of `batch_size` embeddings
+        - "sample" : fit `KMeans` on a random sample of the embeddings which fits within `max_memory_mb` ( or `sample_size` rows if it's set ) and then assign every embedding to its nearest centroid
+
+        For "minibatch" and "sample" the final assignment is done in chunks so that the distance matrix never exceeds `max_memory_mb`.
+
+        `random_state` is fixed by default so that the same embeddings give the same clusters, and so the same cluster prompts, on every run. Set it to None for a different clustering each time, but cluster names then can't be reused from a `CachedInstructorClient`.
+        """
         self.clusters_per_group = clusters_per_group
+        self.mode = mode
+        self.max_memory_mb = max_memory_mb
+        self.batch_size = batch_size
+        self.sample_size = sample_size
+        self.random_state = random_state
 
     def cluster(self, items: list[T]) -> dict[int, list[T]]:
         """
@@ -28,13 +55,78 @@ class KmeansClusteringMethod(BaseClusteringMethod):
 
         embeddings = [item["embedding"] for item in items]  # pyright: ignore
         data: list[T] = [item["item"] for item in items]  # pyright: ignore
-        n_clusters = math.ceil(len(data) / self.clusters_per_group)
 
-        X = np.array(embeddings)
-        kmeans = KMeans(n_clusters=n_clusters)
-        cluster_labels = kmeans.fit_predict(X)
+        return self.cluster_embeddings(np.asarray(embeddings, dtype=np.float32), data)
+
+    def cluster_embeddings(
+        self, embeddings: NDArray[np.float32], items: list[T]
+    ) -> dict[int, list[T]]:
+        n_clusters = math.ceil(len(items) / self.clusters_per_group)
+        cluster_labels = self.fit_predict(embeddings, n_clusters)
+        return {
+            label: [items[j] for j in indices]
+            for label, indices in self.group_by_label(cluster_labels).items()
+        }
+
+    @property
+    def max_memory_bytes(self) -> int:
+        return self.max_memory_mb * 1024 * 1024
+
+    def fit_predict(self, X: NDArray[np.float32], n_clusters: int) -> NDArray[np.int64]:
+        # sklearn is slow to import so we only pay for it when we actually cluster
+        from sklearn.cluster import KMeans, MiniBatchKMeans
+
+        if self.mode == "full":
+            return KMeans(
+                n_clusters=n_clusters, random_state=self.random_state
+            ).fit_predict(X)
+
+        model: Union["KMeans", "MiniBatchKMeans"]
+        if self.mode == "minibatch":
+            model = MiniBatchKMeans(
+                n_clusters=n_clusters,
+                batch_size=self.batch_size,
+                random_state=self.random_state,
+            ).fit(X)
+        elif self.mode == "sample":
+            # We need at least one point per cluster, otherwise we keep as many rows as fit in our memory budget
+            sample_size = self.sample_size or self.max_memory_bytes // (
+                X.shape[1] * X.itemsize
+            )
+            sample_size = min(len(X), max(sample_size, n_clusters))
+            rng = np.random.default_rng(self.random_state)
+            sample = np.sort(rng.choice(len(X), size=sample_size, replace=False))
+            model = KMeans(n_clusters=n_clusters, random_state=self.random_state).fit(
+                X[sample]
+            )
+        else:
+            raise ValueError(f"Unknown k-means mode {self.mode}")
+
+        return self.predict_in_chunks(model, X, n_clusters)
+
+    def predict_in_chunks(
+        self,
+        model: Union["KMeans", "MiniBatchKMeans"],
+        X: NDArray[np.float32],
+        n_clusters: int,
+    ) -> NDArray[np.int64]:
+        # Each row needs its own copy of the embedding and a distance to every centroid
+        row_bytes = X.shape[1] * X.itemsize + n_clusters * 8
+        chunk_size = max(1, self.max_memory_bytes // row_bytes)
+        return np.concatenate(
+            [
+                model.predict(np.asarray(X[i : i + chunk_size]))
+                for i in range(0, len(X), chunk_size)
+            ]
+        )
 
+    @staticmethod
+    def group_by_label(labels: NDArray[np.int64]) -> dict[int, NDArray[np.int64]]:
+        """Map each label to the indices of the items that have it in a single sort rather than one scan per cluster"""
+        order = np.argsort(labels, kind="stable")
+        boundaries = np.flatnonzero(np.diff(labels[order])) + 1
         return {
-            i: [data[j] for j in range(len(data)) if cluster_labels[j] == i]
-            for i in range(n_clusters)
+            int(labels[indices[0]]): indices
+            for indices in np.split(order, boundaries)
+            if len(indices)
         }
@@ -1,18 +1,27 @@
 from kura.dimensionality import HDBUMAP
-from kura.types import Conversation, Cluster
-from kura.embedding import OpenAIEmbeddingModel
+from kura.types import Conversation, Cluster, IncrementalClusterUpdate
+from kura.embedding import OpenAIEmbeddingModel, embedding_model_name
 from kura.summarisation import SummaryModel
 from kura.meta_cluster import MetaClusterModel
 from kura.cluster import ClusterModel
+from kura.centroids import CentroidIndex
+from kura.metrics import MetricsRecorder
+from kura.rate_limit import AdaptiveRateLimiter
 from kura.base_classes import (
     BaseEmbeddingModel,
     BaseSummaryModel,
     BaseClusterModel,
     BaseMetaClusterModel,
     BaseDimensionalityReduction,
+    BaseCheckpointManager,
 )
+from kura.checkpoint import JSONLCheckpointManager
+from kura.dedup import ConversationDeduplicator, content_hash
+from kura import metrics as kura_metrics
+from asyncio import Semaphore
 from pathlib import Path
-from typing import Union
+from typing import AsyncIterator, Optional, Union
+import numpy as np
 import os
 from typing import TypeVar
 from pydantic import BaseModel
@@ -21,32 +30,57 @@ from kura.types.dimensionality import ProjectedCluster
 from kura.types.summarisation import ConversationSummary
 
 T = TypeVar("T", bound=BaseModel)
+C = TypeVar("C", bound=Cluster)
 
 
 class Kura:
     def __init__(
         self,
-        embedding_model: BaseEmbeddingModel = OpenAIEmbeddingModel(),
-        summarisation_model: BaseSummaryModel = SummaryModel(),
-        cluster_model: BaseClusterModel = ClusterModel(),
-        meta_cluster_model: BaseMetaClusterModel = MetaClusterModel(),
-        dimensionality_reduction: BaseDimensionalityReduction = HDBUMAP(),
+        embedding_model: Optional[BaseEmbeddingModel] = None,
+        summarisation_model: Optional[BaseSummaryModel] = None,
+        cluster_model: Optional[BaseClusterModel] = None,
+        meta_cluster_model: Optional[BaseMetaClusterModel] = None,
+        dimensionality_reduction: Optional[BaseDimensionalityReduction] = None,
         max_clusters: int = 10,
         checkpoint_dir: str = "./checkpoints",
         summary_checkpoint_name: str = "summaries.jsonl",
         cluster_checkpoint_name: str = "clusters.jsonl",
         meta_cluster_checkpoint_name: str = "meta_clusters.jsonl",
         dimensionality_checkpoint_name: str = "dimensionality.jsonl",
+        centroid_checkpoint_name: str = "centroids.npz",
+        projection_checkpoint_name: str = "umap.joblib",
+        run_report_name: str = "run_report.json",
         disable_checkpoints: bool = False,
+        checkpoint_manager: Optional[BaseCheckpointManager] = None,
+        metrics: Optional[MetricsRecorder] = None,
+        deduplicator: Optional[ConversationDeduplicator] = None,
+        rate_limiters: Optional[dict[str, AdaptiveRateLimiter]] = None,
     ):
-        # Define Models that we're using
-        self.embedding_model = embedding_model
-        self.embedding_model = embedding_model
-        self.summarisation_model = summarisation_model
+        # The default models that call the same provider share a single limiter, so a 429 from one of them slows all of them down. Pass your own to set requests or tokens per minute for "openai" and "gemini"
+        self.rate_limiters = {
+            "openai": AdaptiveRateLimiter(),
+            "gemini": AdaptiveRateLimiter(),
+            **(rate_limiters or {}),
+        }
+
+        # Define Models that we're using, the defaults are cheap to build since their clients are only created on the first request
+        self.embedding_model = embedding_model or OpenAIEmbeddingModel(
+            rate_limiter=self.rate_limiters["openai"]
+        )
+        self.summarisation_model = summarisation_model or SummaryModel(
+            rate_limiter=self.rate_limiters["openai"]
+        )
         self.max_clusters = max_clusters
-        self.cluster_model = cluster_model
-        self.meta_cluster_model = meta_cluster_model
-        self.dimensionality_reduction = dimensionality_reduction
+        self.cluster_model = cluster_model or ClusterModel(
+            embedding_model=self.embedding_model,
+            rate_limiter=self.rate_limiters["gemini"],
+        )
+        self.meta_cluster_model = meta_cluster_model or MetaClusterModel(
+            embedding_model=self.embedding_model,
+            rate_limiter=self.rate_limiters["gemini"],
+        )
+        # Exact duplicates share a single summary, pass ConversationDeduplicator(threshold=0.85) to group near duplicates too
+        self.deduplicator = deduplicator or ConversationDeduplicator()
 
         # Define Checkpoints
         self.checkpoint_dir = os.path.join(checkpoint_dir)
@@ -62,7 +96,31 @@ class Kura:
         self.summary_checkpoint_name = os.path.join(
             self.checkpoint_dir, summary_checkpoint_name
         )
+        self.centroid_checkpoint_name = os.path.join(
+            self.checkpoint_dir, centroid_checkpoint_name
+        )
+        self.projection_checkpoint_name = os.path.join(
+            self.checkpoint_dir, projection_checkpoint_name
+        )
+        self.run_report_name = os.path.join(self.checkpoint_dir, run_report_name)
         self.disable_checkpoints = disable_checkpoints
+        self.checkpoint_manager = checkpoint_manager or JSONLCheckpointManager()
+
+        # Every stage records its timings, requests, tokens and cache hits here, pass your own recorder to register callbacks
+        self.metrics = metrics or MetricsRecorder()
+
+        # By default we project the clusters with the embeddings computed during meta clustering and keep the fitted projection with the other checkpoints
+        if dimensionality_reduction is None:
+            dimensionality_reduction = HDBUMAP(
+                embedding_model=self.embedding_model,
+                cluster_embeddings=getattr(
+                    self.meta_cluster_model, "cluster_embeddings", None
+                ),
+                projection_path=None
+                if self.disable_checkpoints
+                else self.projection_checkpoint_name,
+            )
+        self.dimensionality_reduction = dimensionality_reduction
 
         if not os.path.exists(self.checkpoint_dir) and not self.disable_checkpoints:
             os.makedirs(self.checkpoint_dir)
@@ -74,19 +132,16 @@ class Kura:
         self, checkpoint_path: str, response_model: type[T]
     ) -> Union[list[T], None]:
         if not self.disable_checkpoints:
-            if os.path.exists(checkpoint_path):
+            if self.checkpoint_manager.exists(checkpoint_path):
                 print(
-                    f"Loading checkpoint from {checkpoint_path} for {response_model.__name__}"
+                    f"Loading checkpoint from {self.checkpoint_manager.path(checkpoint_path)} for {response_model.__name__}"
                 )
-                with open(checkpoint_path, "r") as f:
-                    return [response_model.model_validate_json(line) for line in f]
+                return self.checkpoint_manager.load(checkpoint_path, response_model)
         return None
 
     def save_checkpoint(self, checkpoint_path: str, data: list[T]) -> None:
         if not self.disable_checkpoints:
-            with open(checkpoint_path, "w") as f:
-                for item in data:
-                    f.write(item.model_dump_json() + "\n")
+            self.checkpoint_manager.save(checkpoint_path, data)
 
     async def reduce_clusters(self, clusters: list[Cluster]) -> list[Cluster]:
         checkpoint_items = self.load_checkpoint(
@@ -99,11 +154,14 @@ class Kura:
 
         print(f"Starting with {len(root_clusters)} clusters")
 
+        level = 0
         while len(root_clusters) > self.max_clusters:
+            level += 1
             # We get the updated list of clusters
-            new_current_level = await self.meta_cluster_model.reduce_clusters(
-                root_clusters
-            )
+            with self.metrics.stage(f"meta_level_{level}"):
+                new_current_level = await self.meta_cluster_model.reduce_clusters(
+                    root_clusters
+                )
 
             # These are the new root clusters that we've generated
             root_clusters = [c for c in new_current_level if c.parent_id is None]
@@ -123,15 +181,123 @@ class Kura:
     async def summarise_conversations(
         self, conversations: list[Conversation]
     ) -> list[ConversationSummary]:
-        checkpoint_items = self.load_checkpoint(
-            self.summary_checkpoint_name, ConversationSummary
+        """
+        Summarise the conversations, appending each summary to the checkpoint as soon as it completes.
+
+        If a previous run was interrupted we only summarise the conversations whose chat_ids are missing from the checkpoint and merge them with the summaries we already have.
+
+        Conversations that are duplicates of each other ( or of a conversation we've already summarised ) are only summarised once, every other conversation in the group gets a copy of that summary under its own chat_id.
+        """
+        with self.metrics.stage("summarise"):
+            return await self._summarise_conversations(conversations)
+
+    async def _summarise_conversations(
+        self, conversations: list[Conversation]
+    ) -> list[ConversationSummary]:
+        if self.disable_checkpoints:
+            summaries = {}
+            async for summary in self.summarise_unique(conversations):
+                summaries[summary.chat_id] = summary
+            return [
+                summaries[c.chat_id] for c in conversations if c.chat_id in summaries
+            ]
+
+        summaries = {
+            summary.chat_id: summary
+            for summary in self.load_checkpoint(
+                self.summary_checkpoint_name, ConversationSummary
+            )
+            or []
+        }
+        missing = [c for c in conversations if c.chat_id not in summaries]
+
+        if missing:
+            print(
+                f"Summarising {len(missing)} conversations ({len(conversations) - len(missing)} loaded from checkpoint)"
+            )
+            # Conversations that duplicate one we've already summarised reuse its summary, checkpoints written before we stored content hashes are matched against the conversations we were given
+            existing = {
+                summary.metadata["content_hash"]: summary
+                for summary in summaries.values()
+                if "content_hash" in summary.metadata
+            }
+            for conversation in conversations:
+                if conversation.chat_id in summaries:
+                    existing.setdefault(
+                        content_hash(conversation), summaries[conversation.chat_id]
+                    )
+
+            with self.checkpoint_manager.open_writer(
+                self.summary_checkpoint_name
+            ) as writer:
+                async for summary in self.summarise_unique(missing, existing):
+                    writer.write(summary)
+                    summaries[summary.chat_id] = summary
+
+        return [summaries[c.chat_id] for c in conversations if c.chat_id in summaries]
+
+    async def summarise_unique(
+        self,
+        conversations: list[Conversation],
+        existing: Optional[dict[str, ConversationSummary]] = None,
+    ) -> AsyncIterator[ConversationSummary]:
+        """
+        Summarise one conversation from each group of duplicates, yielding a summary for every conversation in the group as soon as it completes.
+
+        `existing` maps content hashes to summaries we already have, conversations with one of those hashes get a copy straight away.
+        """
+        existing = existing or {}
+        hashes = {c.chat_id: content_hash(c) for c in conversations}
+
+        remaining = []
+        for conversation in conversations:
+            summary = existing.get(hashes[conversation.chat_id])
+            if summary is None:
+                remaining.append(conversation)
+            else:
+                yield self.copy_summary(summary, conversation, hashes)
+
+        groups = self.deduplicator.group(remaining)
+        kura_metrics.increment(
+            "duplicate_conversations", len(conversations) - len(groups)
         )
-        if checkpoint_items:
-            return checkpoint_items
 
-        summaries = await self.summarisation_model.summarise(conversations)
-        self.save_checkpoint(self.summary_checkpoint_name, summaries)
-        return summaries
+        representatives = [members[0] for members in groups.values()]
+        async for summary in self.summarisation_model.summarise_stream(
+            representatives
+        ):
+            summary = summary.model_copy(
+                update={
+                    "metadata": {
+                        **summary.metadata,
+                        "content_hash": hashes[summary.chat_id],
+                    }
+                }
+            )
+            yield summary
+            for member in groups[summary.chat_id][1:]:
+                yield self.copy_summary(summary, member, hashes)
+
+    def copy_summary(
+        self,
+        summary: ConversationSummary,
+        conversation: Conversation,
+        hashes: dict[str, str],
+    ) -> ConversationSummary:
+        """Give `conversation` a copy of a duplicate's summary with metadata that describes `conversation` itself"""
+        return summary.model_copy(
+            update={
+                "chat_id": conversation.chat_id,
+                "metadata": {
+                    **summary.metadata,
+                    **self.summarisation_model.conversation_metadata(conversation),
+                    "content_hash": hashes[conversation.chat_id],
+                    "duplicate_of": summary.metadata.get(
+                        "duplicate_of", summary.chat_id
+                    ),
+                },
+            }
+        )
 
     async def generate_base_clusters(self, summaries: list[ConversationSummary]):
         base_cluster_checkpoint_items = self.load_checkpoint(
@@ -140,8 +306,17 @@ class Kura:
         if base_cluster_checkpoint_items:
             return base_cluster_checkpoint_items
 
-        clusters: list[Cluster] = await self.cluster_model.cluster_summaries(summaries)
+        with self.metrics.stage("base_clusters"):
+            clusters: list[Cluster] = await self.cluster_model.cluster_summaries(
+                summaries
+            )
         self.save_checkpoint(self.cluster_checkpoint_name, clusters)
+
+        centroid_index: Optional[CentroidIndex] = getattr(
+            self.cluster_model, "centroid_index", None
+        )
+        if centroid_index is not None and not self.disable_checkpoints:
+            centroid_index.save(self.centroid_checkpoint_name)
         return clusters
 
     async def reduce_dimensionality(
@@ -153,9 +328,10 @@ class Kura:
         if checkpoint_items:
             return checkpoint_items
 
-        dimensionality_reduced_clusters = (
-            await self.dimensionality_reduction.reduce_dimensionality(clusters)
-        )
+        with self.metrics.stage("dimensionality"):
+            dimensionality_reduced_clusters = (
+                await self.dimensionality_reduction.reduce_dimensionality(clusters)
+            )
 
         self.save_checkpoint(
             self.dimensionality_checkpoint_name, dimensionality_reduced_clusters
@@ -165,9 +341,130 @@ class Kura:
     async def cluster_conversations(self, conversations: list[Conversation]):
         summaries = await self.summarise_conversations(conversations)
         clusters: list[Cluster] = await self.generate_base_clusters(summaries)
-        processed_clusters: list[Cluster] = await self.reduce_clusters(clusters)
-        dimensionality_reduced_clusters = await self.reduce_dimensionality(
-            processed_clusters
-        )
+        try:
+            processed_clusters: list[Cluster] = await self.reduce_clusters(clusters)
+            dimensionality_reduced_clusters = await self.reduce_dimensionality(
+                processed_clusters
+            )
+        finally:
+            # Cluster embeddings are only shared between meta clustering and the projection of a single run, a long lived Kura would otherwise hold on to every cluster it has ever embedded
+            cluster_embeddings = getattr(
+                self.meta_cluster_model, "cluster_embeddings", None
+            )
+            if cluster_embeddings is not None:
+                cluster_embeddings.clear()
+
+        if not self.disable_checkpoints:
+            self.metrics.write_report(self.run_report_name)
 
         return dimensionality_reduced_clusters
+
+    async def assign_new_conversations(
+        self, conversations: list[Conversation], drift_threshold: float = 0.05
+    ) -> IncrementalClusterUpdate:
+        """
+        Add new conversations to the cluster hierarchy stored in the checkpoint directory without re-running the full pipeline.
+
+        We only summarise and embed the new conversations, assign each of them to the base cluster with the nearest centroid and then add their chat ids to every cluster up the parent chain. Base clusters whose centroid has moved more than `drift_threshold` ( in cosine distance ) from where it was when the cluster was labelled are returned in `drifted_cluster_ids` so they can be relabelled.
+
+        The summary, cluster, meta cluster, dimensionality and centroid checkpoints are updated in place.
+        """
+        if self.disable_checkpoints:
+            raise ValueError("Incremental assignment requires checkpoints")
+
+        base_clusters = self.load_checkpoint(self.cluster_checkpoint_name, Cluster)
+        if not base_clusters or not os.path.exists(self.centroid_checkpoint_name):
+            raise ValueError(
+                f"No base clusters or centroid index found in {self.checkpoint_dir}, run cluster_conversations first"
+            )
+        centroid_index = CentroidIndex.load(self.centroid_checkpoint_name)
+
+        assigned_chat_ids = {
+            chat_id for cluster in base_clusters for chat_id in cluster.chat_ids
+        }
+        new_conversations = [
+            c for c in conversations if c.chat_id not in assigned_chat_ids
+        ]
+        if not new_conversations:
+            meta_clusters = self.load_checkpoint(
+                self.meta_cluster_checkpoint_name, Cluster
+            )
+            return IncrementalClusterUpdate(
+                clusters=meta_clusters or base_clusters,
+                assignments={},
+                drifted_cluster_ids=[],
+            )
+
+        # The centroids were computed from the cluster model's embeddings so new summaries have to be embedded by the same model
+        embedding_model = getattr(
+            self.cluster_model, "embedding_model", self.embedding_model
+        )
+        centroid_index.check_embedding_model(embedding_model_name(embedding_model))
+
+        summaries = await self.summarise_conversations(new_conversations)
+        embeddings = np.asarray(
+            await embedding_model.embed_batch(
+                [summary.summary for summary in summaries], Semaphore(50)
+            ),
+            dtype=np.float32,
+        )
+        nearest, _ = centroid_index.nearest(embeddings, k=1)
+
+        additions: dict[str, list[str]] = {}
+        for summary, row in zip(summaries, nearest[:, 0]):
+            additions.setdefault(centroid_index.ids[row], []).append(summary.chat_id)
+
+        for row in np.unique(nearest[:, 0]):
+            centroid_index.add(int(row), embeddings[nearest[:, 0] == row])
+
+        drift = centroid_index.drift()
+        drifted_cluster_ids = [
+            centroid_index.ids[row]
+            for row in np.flatnonzero(drift > drift_threshold)
+            if centroid_index.ids[row] in additions
+        ]
+
+        base_clusters = self.add_chat_ids(base_clusters, additions)
+        self.save_checkpoint(self.cluster_checkpoint_name, base_clusters)
+        centroid_index.save(self.centroid_checkpoint_name)
+
+        meta_clusters = self.load_checkpoint(self.meta_cluster_checkpoint_name, Cluster)
+        if meta_clusters:
+            meta_clusters = self.add_chat_ids(meta_clusters, additions)
+            self.save_checkpoint(self.meta_cluster_checkpoint_name, meta_clusters)
+
+        projected_clusters = self.load_checkpoint(
+            self.dimensionality_checkpoint_name, ProjectedCluster
+        )
+        if projected_clusters:
+            projected_clusters = self.add_chat_ids(projected_clusters, additions)
+            self.save_checkpoint(
+                self.dimensionality_checkpoint_name, projected_clusters
+            )
+
+        print(
+            f"Assigned {len(summaries)} conversations to {len(additions)} clusters, {len(drifted_cluster_ids)} clusters have drifted"
+        )
+        return IncrementalClusterUpdate(
+            clusters=meta_clusters or base_clusters,
+            assignments={
+                chat_id: cluster_id
+                for cluster_id, chat_ids in additions.items()
+                for chat_id in chat_ids
+            },
+            drifted_cluster_ids=drifted_cluster_ids,
+        )
+
+    def add_chat_ids(
+        self, clusters: list[C], additions: dict[str, list[str]]
+    ) -> list[C]:
+        """Add chat ids to the given clusters and to every one of their ancestors"""
+        id_to_cluster = {cluster.id: cluster for cluster in clusters}
+        for cluster_id, chat_ids in additions.items():
+            current = id_to_cluster.get(cluster_id)
+            while current is not None:
+                current.chat_ids = current.chat_ids + chat_ids
+                current = (
+                    id_to_cluster.get(current.parent_id) if current.parent_id else None
+                )
+        return clusters
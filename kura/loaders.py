@@ -0,0 +1,257 @@
+"""
+Load conversations from tabular exports ( CSV or Parquet ) in chunks so that large files can be streamed into the pipeline.
+
+Files can either hold one message per row with a role column, or one exchange per row with the user's message and the assistant's response in separate columns. Rows that belong to the same conversation are expected to be next to each other, pass `assume_sorted=False` if they aren't and we'll group the whole file in memory instead.
+"""
+
+from itertools import islice
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator, Literal, Optional
+
+import numpy as np
+from pydantic import BaseModel, TypeAdapter
+
+from kura.types import Conversation, Message
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+messages_adapter = TypeAdapter(list[Message])
+
+
+class ColumnMapping(BaseModel):
+    chat_id: str = "chat_id"
+    created_at: str = "created_at"
+    # One message per row
+    role: Optional[str] = "role"
+    content: Optional[str] = "content"
+    # One exchange per row, when these are set the role and content columns are ignored
+    user_content: Optional[str] = None
+    assistant_content: Optional[str] = None
+    # Defaults to the timestamp of the first message when not set
+    conversation_created_at: Optional[str] = None
+    # Values in the role column that should be read as a user or assistant message
+    role_values: dict[str, Literal["user", "assistant"]] = {
+        "user": "user",
+        "human": "user",
+        "assistant": "assistant",
+        "ai": "assistant",
+    }
+
+    @property
+    def paired(self) -> bool:
+        return self.user_content is not None or self.assistant_content is not None
+
+    def columns(self) -> list[str]:
+        columns = [self.chat_id, self.created_at]
+        if self.paired:
+            columns += [c for c in (self.user_content, self.assistant_content) if c]
+        else:
+            if self.role is None or self.content is None:
+                raise ValueError(
+                    "Either role and content or user_content and assistant_content must be mapped"
+                )
+            columns += [self.role, self.content]
+        if self.conversation_created_at:
+            columns.append(self.conversation_created_at)
+        return list(dict.fromkeys(columns))
+
+
+def read_chunks(
+    path: str,
+    columns: list[str],
+    chunk_size: int,
+    file_format: Optional[Literal["csv", "parquet"]] = None,
+) -> Iterator["pd.DataFrame"]:
+    path = str(Path(path).expanduser())
+    file_format = file_format or (
+        "parquet" if Path(path).suffix.lower() in (".parquet", ".pq") else "csv"
+    )
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(
+            batch_size=chunk_size, columns=columns
+        ):
+            yield batch.to_pandas()
+    elif file_format == "csv":
+        import pandas as pd
+
+        yield from pd.read_csv(
+            path,
+            usecols=columns,
+            chunksize=chunk_size,
+            dtype={column: "string" for column in columns},
+        )
+    else:
+        raise ValueError(f"Unsupported file format: {file_format}")
+
+
+def to_messages(chunk: "pd.DataFrame", mapping: ColumnMapping) -> "pd.DataFrame":
+    """
+    Normalise a chunk into one message per row with chat_id, created_at, role and content columns.
+    """
+    import pandas as pd
+
+    created_at = pd.to_datetime(chunk[mapping.created_at])
+    conversation_created_at = (
+        pd.to_datetime(chunk[mapping.conversation_created_at])
+        if mapping.conversation_created_at
+        else None
+    )
+
+    if mapping.paired:
+        # Interleave the user and assistant columns so each exchange becomes two consecutive messages
+        roles = [
+            (role, column)
+            for role, column in (
+                ("user", mapping.user_content),
+                ("assistant", mapping.assistant_content),
+            )
+            if column
+        ]
+        n = len(chunk)
+        frames = [
+            pd.DataFrame(
+                {
+                    "chat_id": chunk[mapping.chat_id].to_numpy(),
+                    "created_at": created_at.array,
+                    "conversation_created_at": None
+                    if conversation_created_at is None
+                    else conversation_created_at.array,
+                    "role": role,
+                    "content": chunk[column].to_numpy(),
+                    "order": np.arange(n) * len(roles) + i,
+                }
+            )
+            for i, (role, column) in enumerate(roles)
+        ]
+        messages = pd.concat(frames).sort_values("order", kind="stable")
+    else:
+        role = chunk[mapping.role].map(mapping.role_values)
+        unknown = chunk[mapping.role][role.isna()]
+        if len(unknown):
+            raise ValueError(
+                f"Unknown roles {sorted(unknown.astype(str).unique())[:5]}, map them with ColumnMapping.role_values"
+            )
+        messages = pd.DataFrame(
+            {
+                "chat_id": chunk[mapping.chat_id].to_numpy(),
+                "created_at": created_at.array,
+                "conversation_created_at": None
+                if conversation_created_at is None
+                else conversation_created_at.array,
+                "role": role.to_numpy(),
+                "content": chunk[mapping.content].to_numpy(),
+            }
+        )
+
+    messages["chat_id"] = messages["chat_id"].astype(str)
+    messages["content"] = messages["content"].fillna("").astype(str)
+    return messages.reset_index(drop=True)
+
+
+def build_conversations(messages: "pd.DataFrame") -> list[Conversation]:
+    """
+    Build a conversation for each run of rows with the same chat_id without going through pandas row by row.
+    """
+    import pandas as pd
+
+    if messages.empty:
+        return []
+
+    chat_ids = messages["chat_id"].to_numpy()
+    created_at = pd.DatetimeIndex(messages["created_at"]).to_pydatetime()
+    conversation_created_at = (
+        pd.DatetimeIndex(messages["conversation_created_at"]).to_pydatetime()
+        if messages["conversation_created_at"].notna().any()
+        else None
+    )
+    roles = messages["role"].to_numpy()
+    contents = messages["content"].to_numpy()
+
+    # Validating every message in a single call is much cheaper than building them one at a time
+    all_messages = messages_adapter.validate_python(
+        [
+            {"created_at": c, "role": r, "content": t}
+            for c, r, t in zip(created_at, roles, contents)
+        ]
+    )
+
+    starts = np.flatnonzero(np.r_[True, chat_ids[1:] != chat_ids[:-1]])
+    ends = np.r_[starts[1:], len(chat_ids)]
+    return [
+        Conversation(
+            chat_id=chat_ids[start],
+            created_at=created_at[start]
+            if conversation_created_at is None
+            else conversation_created_at[start],
+            messages=all_messages[start:end],
+        )
+        for start, end in zip(starts, ends)
+    ]
+
+
+def iter_conversations(
+    path: str,
+    mapping: Optional[ColumnMapping] = None,
+    chunk_size: int = 100_000,
+    file_format: Optional[Literal["csv", "parquet"]] = None,
+    assume_sorted: bool = True,
+    max_conversations: Optional[int] = None,
+) -> Iterator[Conversation]:
+    """
+    Lazily yield the conversations in a CSV or Parquet file, reading `chunk_size` rows at a time.
+    """
+    import pandas as pd
+
+    mapping = mapping or ColumnMapping()
+    chunks = (
+        to_messages(chunk, mapping)
+        for chunk in read_chunks(path, mapping.columns(), chunk_size, file_format)
+    )
+
+    if not assume_sorted:
+        messages = pd.concat(list(chunks), ignore_index=True)
+        # A stable sort keeps the messages of each conversation in file order
+        chunks = iter([messages.sort_values("chat_id", kind="stable")])
+
+    def conversations() -> Iterator[Conversation]:
+        pending = None
+        for messages in chunks:
+            if pending is not None:
+                messages = pd.concat([pending, messages], ignore_index=True)
+            if messages.empty:
+                continue
+
+            # The last conversation in a chunk might carry on into the next one so we hold it back
+            last = messages["chat_id"].iat[-1]
+            tail = messages["chat_id"].to_numpy() == last
+            first_tail = len(tail) - np.argmin(tail[::-1]) if not tail.all() else 0
+            pending = messages.iloc[first_tail:]
+            yield from build_conversations(messages.iloc[:first_tail])
+
+        if pending is not None:
+            yield from build_conversations(pending)
+
+    yield from islice(conversations(), max_conversations)
+
+
+def iter_conversation_batches(
+    path: str,
+    mapping: Optional[ColumnMapping] = None,
+    batch_size: int = 1000,
+    **kwargs,
+) -> Iterator[list[Conversation]]:
+    """
+    Yield lists of up to `batch_size` conversations, see `iter_conversations` for the remaining arguments.
+    """
+    conversations = iter_conversations(path, mapping, **kwargs)
+    while batch := list(islice(conversations, batch_size)):
+        yield batch
+
+
+def load_conversations(
+    path: str, mapping: Optional[ColumnMapping] = None, **kwargs
+) -> list[Conversation]:
+    return list(iter_conversations(path, mapping, **kwargs))
@@ -1,3 +1,4 @@
+from kura import metrics
 from kura.base_classes import (
     BaseMetaClusterModel,
     BaseEmbeddingModel,
@@ -5,13 +6,15 @@ from kura.base_classes import (
 )
 import math
 from kura.types.cluster import Cluster, GeneratedCluster
-from kura.embedding import OpenAIEmbeddingModel
+from kura.embedding import OpenAIEmbeddingModel, cluster_text, cluster_text_hash
 from kura.k_means import KmeansClusteringMethod
-import instructor
-import google.generativeai as genai
+from kura.rate_limit import AdaptiveRateLimiter, estimate_tokens
+from kura.clients import create_completion, get_gemini_client
 from tqdm.asyncio import tqdm_asyncio
-from asyncio import Semaphore
+from asyncio import Semaphore, to_thread
 from pydantic import BaseModel, field_validator, ValidationInfo
+from typing import Literal, Optional
+import numpy as np
 import re
 
 
@@ -49,26 +52,61 @@ class ClusterLabel(BaseModel):
         return v
 
 
+class ClusterAssignment(BaseModel):
+    cluster_id: int
+    higher_level_cluster: str
+
+    @field_validator("higher_level_cluster")
+    def strip_higher_level_cluster(cls, v: str) -> str:
+        return v.strip()
+
+
+class ClusterLabels(BaseModel):
+    # Assignments aren't validated against the candidates here, a single bad label would otherwise make us regenerate the whole batch
+    assignments: list[ClusterAssignment]
+
+
 class MetaClusterModel(BaseMetaClusterModel):
     def __init__(
         self,
         max_concurrent_requests: int = 50,
-        client=instructor.from_gemini(
-            genai.GenerativeModel("gemini-1.5-flash-latest"), use_async=True
-        ),
-        embedding_model: BaseEmbeddingModel = OpenAIEmbeddingModel(),
-        clustering_model: BaseClusteringMethod = KmeansClusteringMethod(12),
+        client=None,
+        embedding_model: Optional[BaseEmbeddingModel] = None,
+        clustering_model: Optional[BaseClusteringMethod] = None,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        label_batch_size: int = 25,
+        assignment_mode: Literal["llm", "embedding"] = "llm",
+        assignment_margin: float = 0.05,
     ):
         self.max_concurrent_requests = max_concurrent_requests
-        self.client = client
-        self.embedding_model = embedding_model
-        self.clustering_model = clustering_model
+        # Number of clusters we ask the model to label in a single call, set this to 1 to label each cluster on its own
+        self.label_batch_size = label_batch_size
+        # In embedding mode clusters go to the most similar candidate and we only ask the model when the top two candidates are within `assignment_margin` of each other
+        self.assignment_mode = assignment_mode
+        self.assignment_margin = assignment_margin
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter(
+            max_concurrency=max_concurrent_requests
+        )
+        self._client = client
+        self.embedding_model = embedding_model or OpenAIEmbeddingModel()
+        self.clustering_model = clustering_model or KmeansClusteringMethod(12)
+        # Embeddings of every cluster we've embedded so far keyed by `cluster_text_hash` so that each level only embeds the clusters it hasn't seen. Kura clears it after each run, clear it yourself if you call `reduce_clusters` directly
+        self.cluster_embeddings: dict[str, list[float]] = {}
+
+    @property
+    def client(self):
+        # The default Gemini client is created on the first request and shared between models
+        if self._client is None:
+            self._client = get_gemini_client()
+        return self._client
 
     async def generate_candidate_clusters(
         self, clusters: list[Cluster], sem: Semaphore
     ) -> list[str]:
         async with sem:
-            resp = await self.client.chat.completions.create(
+            resp = await create_completion(
+                self.client,
+                self.rate_limiter,
                 messages=[
                     {
                         "role": "system",
@@ -97,6 +135,10 @@ class MetaClusterModel(BaseMetaClusterModel):
                     }
                 ],
                 response_model=CandidateClusters,
+                estimated_tokens=estimate_tokens(
+                    *[f"{c.name}: {c.description}" for c in clusters]
+                )
+                + 500,
                 context={
                     "clusters": clusters,
                     "desired_number": math.ceil(len(clusters) / 2),
@@ -107,7 +149,9 @@ class MetaClusterModel(BaseMetaClusterModel):
 
     async def label_cluster(self, cluster: Cluster, candidate_clusters: list[str]):
         async with self.sem:
-            resp = await self.client.chat.completions.create(
+            resp = await create_completion(
+                self.client,
+                self.rate_limiter,
                 messages=[
                     {
                         "role": "system",
@@ -154,6 +198,10 @@ Based on this information, determine the most appropriate higher-level cluster a
                     }
                 ],
                 response_model=ClusterLabel,
+                estimated_tokens=estimate_tokens(
+                    *candidate_clusters, cluster.name, cluster.description
+                )
+                + 500,
                 context={
                     "cluster": cluster,
                     "candidate_clusters": candidate_clusters,
@@ -165,9 +213,173 @@ Based on this information, determine the most appropriate higher-level cluster a
                 "label": resp.higher_level_cluster,
             }
 
+    async def label_clusters(
+        self, clusters: list[Cluster], candidate_clusters: list[str]
+    ) -> list[dict]:
+        """
+        Label a batch of clusters with a single call. Any cluster whose label is missing or isn't one of the candidates is retried on its own with `label_cluster`.
+        """
+        if len(clusters) == 1:
+            return [await self.label_cluster(clusters[0], candidate_clusters)]
+
+        async with self.sem:
+            resp = await create_completion(
+                self.client,
+                self.rate_limiter,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": """
+You are tasked with categorizing specific clusters into the provided higher-level clusters for observability, monitoring, and content moderation. Your goal is to determine which higher-level cluster best fits each of the given specific clusters based on its name and description.
+
+First, here are the ONLY valid higher-level clusters you may select from:
+<higher_level_clusters>
+{% for cluster in candidate_clusters %}
+<higher_level_cluster>{{ cluster }}</higher_level_cluster>
+{% endfor %}
+</higher_level_clusters>
+
+Here are the specific clusters to categorize:
+<specific_clusters>
+{% for cluster in clusters %}
+<specific_cluster id="{{ loop.index }}">
+Name: {{ cluster.name }}
+Description: {{ cluster.description }}
+</specific_cluster>
+{% endfor %}
+</specific_clusters>
+
+RULES:
+1. You MUST return EXACTLY ONE assignment for every specific cluster, using the id of the specific cluster as the cluster_id
+2. You MUST select EXACTLY ONE higher-level cluster from the provided list for each specific cluster
+3. You MUST output the higher-level cluster name EXACTLY as written - no modifications allowed
+4. You MUST NOT create new cluster names or combinations
+5. You MUST NOT use partial matches or approximate names
+
+CLASSIFICATION PROCESS:
+1. First, record the exact list of valid higher-level clusters
+2. Read each specific cluster's name and description carefully
+3. Compare each specific cluster's key characteristics against each valid higher-level cluster
+4. Select the single most appropriate higher-level cluster that encompasses each specific cluster
+5. Verify each selected cluster exactly matches one from the valid list
+
+Based on this information, determine the most appropriate higher-level cluster for each specific cluster and provide your answer as instructed.
+                        """,
+                    }
+                ],
+                response_model=ClusterLabels,
+                estimated_tokens=estimate_tokens(
+                    *candidate_clusters,
+                    *[f"{c.name}: {c.description}" for c in clusters],
+                )
+                + 500,
+                context={
+                    "clusters": clusters,
+                    "candidate_clusters": candidate_clusters,
+                },
+                max_retries=3,
+            )
+
+        candidates = set(candidate_clusters)
+        labels: dict[int, str] = {}
+        for assignment in resp.assignments:
+            index = assignment.cluster_id - 1
+            if (
+                0 <= index < len(clusters)
+                and index not in labels
+                and assignment.higher_level_cluster in candidates
+            ):
+                labels[index] = assignment.higher_level_cluster
+
+        failed = [cluster for i, cluster in enumerate(clusters) if i not in labels]
+        metrics.increment("label_retries", len(failed))
+        retried = await tqdm_asyncio.gather(
+            *[self.label_cluster(cluster, candidate_clusters) for cluster in failed],
+            disable=True,
+        )
+        retried_labels = {item["cluster"].id: item["label"] for item in retried}
+
+        return [
+            {
+                "cluster": cluster,
+                "label": labels[i] if i in labels else retried_labels[cluster.id],
+            }
+            for i, cluster in enumerate(clusters)
+        ]
+
+    async def assign_by_embedding(
+        self, clusters: list[Cluster], candidate_clusters: list[str]
+    ) -> list[dict]:
+        """
+        Assign each cluster to the candidate with the most similar embedding, falling back to the model for clusters where the best two candidates are too close to call.
+        """
+        # A repeated candidate would always tie with itself and send every cluster closest to it to the model
+        candidate_clusters = list(dict.fromkeys(candidate_clusters))
+        candidate_embeddings = np.asarray(
+            await self.embedding_model.embed_batch(candidate_clusters, self.sem),
+            dtype=np.float32,
+        )
+        cluster_embeddings = np.asarray(
+            await self.embed_clusters(clusters), dtype=np.float32
+        )
+        candidate_embeddings /= np.maximum(
+            np.linalg.norm(candidate_embeddings, axis=1, keepdims=True), 1e-12
+        )
+        cluster_embeddings /= np.maximum(
+            np.linalg.norm(cluster_embeddings, axis=1, keepdims=True), 1e-12
+        )
+        similarity = cluster_embeddings @ candidate_embeddings.T
+
+        best = similarity.argmax(axis=1)
+        if len(candidate_clusters) > 1:
+            top_two = np.sort(similarity, axis=1)[:, -2:]
+            margin = top_two[:, 1] - top_two[:, 0]
+        else:
+            margin = np.full(len(clusters), np.inf)
+
+        uncertain = [
+            cluster
+            for cluster, m in zip(clusters, margin)
+            if m < self.assignment_margin
+        ]
+        metrics.increment("assignment_fallbacks", len(uncertain))
+        metrics.increment("embedding_assignments", len(clusters) - len(uncertain))
+
+        fallback = await self.label_with_llm(uncertain, candidate_clusters)
+        fallback_labels = {item["cluster"].id: item["label"] for item in fallback}
+        return [
+            {
+                "cluster": cluster,
+                "label": fallback_labels.get(cluster.id, candidate_clusters[b]),
+            }
+            for cluster, b in zip(clusters, best)
+        ]
+
+    async def label_with_llm(
+        self, clusters: list[Cluster], candidate_clusters: list[str]
+    ) -> list[dict]:
+        if self.label_batch_size > 1:
+            batches = await tqdm_asyncio.gather(
+                *[
+                    self.label_clusters(
+                        clusters[i : i + self.label_batch_size], candidate_clusters
+                    )
+                    for i in range(0, len(clusters), self.label_batch_size)
+                ],
+                disable=True,
+            )
+            return [label for batch in batches for label in batch]
+
+        return await tqdm_asyncio.gather(
+            *[self.label_cluster(cluster, candidate_clusters) for cluster in clusters],
+            disable=True,
+        )
+
     async def rename_cluster_group(self, clusters: list[Cluster]) -> list[Cluster]:
         async with self.sem:
-            resp = await self.client.chat.completions.create(
+            resp = await create_completion(
+                self.client,
+                self.rate_limiter,
                 messages=[
                     {
                         "role": "system",
@@ -193,6 +405,10 @@ Based on this information, determine the most appropriate higher-level cluster a
                 ],
                 context={"clusters": clusters},
                 response_model=GeneratedCluster,
+                estimated_tokens=estimate_tokens(
+                    *[f"{c.name}: {c.description}" for c in clusters]
+                )
+                + 500,
             )
 
             res = []
@@ -226,10 +442,10 @@ Based on this information, determine the most appropriate higher-level cluster a
             clusters, Semaphore(self.max_concurrent_requests)
         )
 
-        cluster_labels = await tqdm_asyncio.gather(
-            *[self.label_cluster(cluster, candidate_labels) for cluster in clusters],
-            disable=True,
-        )
+        if self.assignment_mode == "embedding":
+            cluster_labels = await self.assign_by_embedding(clusters, candidate_labels)
+        else:
+            cluster_labels = await self.label_with_llm(clusters, candidate_labels)
 
         label_to_clusters = {}
         for label in cluster_labels:
@@ -252,6 +468,23 @@ Based on this information, determine the most appropriate higher-level cluster a
 
         return res
 
+    async def embed_clusters(self, clusters: list[Cluster]) -> list[list[float]]:
+        """Embed the name and description of each cluster, reusing the embeddings of clusters from previous levels"""
+        keys = [cluster_text_hash(cluster) for cluster in clusters]
+        missing = {
+            key: cluster_text(cluster)
+            for key, cluster in zip(keys, clusters)
+            if key not in self.cluster_embeddings
+        }
+        if missing:
+            embeddings = await self.embedding_model.embed_batch(
+                list(missing.values()),
+                self.sem,
+                desc="Embedding Clusters",
+            )
+            self.cluster_embeddings.update(zip(missing, embeddings))
+        return [self.cluster_embeddings[key] for key in keys]
+
     async def reduce_clusters(self, clusters: list[Cluster]) -> list[Cluster]:
         """
         This takes in a list of existing clusters and generates a few higher order clusters that are more general. This represents a single iteration of the meta clustering process.
@@ -269,19 +502,7 @@ Based on this information, determine the most appropriate higher-level cluster a
             return [new_cluster, clusters[0]]
 
         self.sem = Semaphore(self.max_concurrent_requests)
-        cluster_embeddings: list[list[float]] = await tqdm_asyncio.gather(
-            *[
-                self.embedding_model.embed(
-                    f"""
-Name: {cluster.name}
-Description: {cluster.description}
-                """.strip(),
-                    self.sem,
-                )
-                for cluster in clusters
-            ],
-            desc="Embedding Clusters",
-        )
+        cluster_embeddings = await self.embed_clusters(clusters)
         clusters_and_embeddings = [
             {
                 "item": cluster,
@@ -290,8 +511,8 @@ Description: {cluster.description}
             for cluster, embedding in zip(clusters, cluster_embeddings)
         ]
 
-        cluster_id_to_clusters: dict[int, list[Cluster]] = (
-            self.clustering_model.cluster(clusters_and_embeddings)
+        cluster_id_to_clusters: dict[int, list[Cluster]] = await to_thread(
+            self.clustering_model.cluster, clusters_and_embeddings
         )
 
         new_clusters = await tqdm_asyncio.gather(
@@ -0,0 +1,289 @@
+"""
+Per-stage metrics for a Kura run.
+
+`Kura` opens a stage ( eg. "summarise" or "meta_level_1" ) around each step of the pipeline. Anything that makes a request or hits a cache while that stage is active records into it through the module level helpers below, so models don't need a reference to the recorder.
+"""
+
+import json
+import random
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+import numpy as np
+from pydantic import BaseModel, Field
+
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+# Percentiles are estimated from a uniform sample of at most this many latencies so that long running recorders ( eg. the server's ) stay a fixed size
+RESERVOIR_SIZE = 1024
+
+
+class RequestMetrics(BaseModel):
+    requests: int = 0
+    failures: int = 0
+    retries: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Non cumulative counts for each of LATENCY_BUCKETS followed by +Inf
+    bucket_counts: list[int] = Field(
+        default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1), exclude=True
+    )
+    latency_sum: float = Field(default=0.0, exclude=True)
+    latency_count: int = Field(default=0, exclude=True)
+    reservoir: list[float] = Field(default_factory=list, exclude=True)
+
+    def observe(self, latency: float) -> None:
+        self.bucket_counts[bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+        self.latency_count += 1
+        if len(self.reservoir) < RESERVOIR_SIZE:
+            self.reservoir.append(latency)
+        else:
+            # Reservoir sampling keeps every latency seen so far equally likely to be in the sample
+            i = random.randrange(self.latency_count)
+            if i < RESERVOIR_SIZE:
+                self.reservoir[i] = latency
+
+    def merge(self, other: "RequestMetrics") -> None:
+        total = self.latency_count + other.latency_count
+        if len(self.reservoir) + len(other.reservoir) <= RESERVOIR_SIZE:
+            self.reservoir = self.reservoir + other.reservoir
+        elif total:
+            # Each side contributes in proportion to the number of latencies it has seen
+            ours = round(RESERVOIR_SIZE * self.latency_count / total)
+            ours = min(ours, len(self.reservoir))
+            theirs = min(RESERVOIR_SIZE - ours, len(other.reservoir))
+            self.reservoir = random.sample(self.reservoir, ours) + random.sample(
+                other.reservoir, theirs
+            )
+
+        self.requests += other.requests
+        self.failures += other.failures
+        self.retries += other.retries
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.bucket_counts = [
+            a + b for a, b in zip(self.bucket_counts, other.bucket_counts)
+        ]
+        self.latency_sum += other.latency_sum
+        self.latency_count = total
+
+    def percentiles(self) -> dict[str, float]:
+        if not self.reservoir:
+            return {}
+        values = np.percentile(self.reservoir, [50, 90, 99])
+        return {"p50": float(values[0]), "p90": float(values[1]), "p99": float(values[2])}
+
+    def histogram(self) -> dict[str, int]:
+        """Cumulative counts of requests that completed within each bucket, like a Prometheus histogram"""
+        counts = np.cumsum(self.bucket_counts)
+        res = {str(bucket): int(count) for bucket, count in zip(LATENCY_BUCKETS, counts)}
+        res["+Inf"] = int(counts[-1])
+        return res
+
+
+class CacheMetrics(BaseModel):
+    hits: int = 0
+    misses: int = 0
+
+
+class StageMetrics(BaseModel):
+    name: str
+    wall_time: float = 0.0
+    requests: dict[str, RequestMetrics] = Field(default_factory=dict)
+    caches: dict[str, CacheMetrics] = Field(default_factory=dict)
+    counters: dict[str, int] = Field(default_factory=dict)
+
+    def report(self) -> dict:
+        return {
+            "name": self.name,
+            "wall_time": self.wall_time,
+            "requests": {
+                kind: {
+                    **metrics.model_dump(),
+                    "latency": metrics.percentiles(),
+                    "latency_histogram": metrics.histogram(),
+                }
+                for kind, metrics in self.requests.items()
+            },
+            "caches": {name: cache.model_dump() for name, cache in self.caches.items()},
+            "counters": self.counters,
+        }
+
+
+class MetricsCallback:
+    """Subclass this and override the hooks you care about to receive metrics as the run progresses"""
+
+    def on_stage_start(self, stage: str) -> None:
+        pass
+
+    def on_stage_end(self, stage: StageMetrics) -> None:
+        pass
+
+    def on_request(
+        self, stage: str, kind: str, latency: float, success: bool, retries: int
+    ) -> None:
+        pass
+
+
+class MetricsRecorder:
+    def __init__(self, callbacks: Optional[list[MetricsCallback]] = None):
+        self.callbacks = callbacks or []
+        self.stages: dict[str, StageMetrics] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        stage = self.stages.setdefault(name, StageMetrics(name=name))
+        for callback in self.callbacks:
+            callback.on_stage_start(name)
+
+        token = _current_stage.set((self, stage))
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.wall_time += time.perf_counter() - start
+            _current_stage.reset(token)
+            for callback in self.callbacks:
+                callback.on_stage_end(stage)
+
+    def merge(self, other: "MetricsRecorder") -> None:
+        """Add everything recorded by `other` into this recorder, eg. to aggregate the metrics of several runs"""
+        for name, theirs in other.stages.items():
+            ours = self.stages.setdefault(name, StageMetrics(name=name))
+            ours.wall_time += theirs.wall_time
+            for kind, r in theirs.requests.items():
+                ours.requests.setdefault(kind, RequestMetrics()).merge(r)
+            for cache_name, c in theirs.caches.items():
+                cache = ours.caches.setdefault(cache_name, CacheMetrics())
+                cache.hits += c.hits
+                cache.misses += c.misses
+            for counter, value in theirs.counters.items():
+                ours.counters[counter] = ours.counters.get(counter, 0) + value
+
+    def report(self) -> dict:
+        return {
+            "stages": [stage.report() for stage in self.stages.values()],
+            "total_wall_time": sum(stage.wall_time for stage in self.stages.values()),
+        }
+
+    def write_report(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def to_prometheus(self) -> str:
+        """Render every stage in the Prometheus text exposition format"""
+        families: dict[str, tuple[str, list[str]]] = {
+            "kura_stage_wall_time_seconds": ("gauge", []),
+            "kura_requests_total": ("counter", []),
+            "kura_request_failures_total": ("counter", []),
+            "kura_request_retries_total": ("counter", []),
+            "kura_tokens_total": ("counter", []),
+            "kura_request_latency_seconds": ("histogram", []),
+            "kura_cache_requests_total": ("counter", []),
+            "kura_events_total": ("counter", []),
+        }
+
+        def add(family: str, labels: str, value: float, suffix: str = "") -> None:
+            families[family][1].append(f"{family}{suffix}{{{labels}}} {value}")
+
+        for s in self.stages.values():
+            add("kura_stage_wall_time_seconds", f'stage="{s.name}"', s.wall_time)
+            for kind, r in s.requests.items():
+                labels = f'stage="{s.name}",kind="{kind}"'
+                add("kura_requests_total", labels, r.requests)
+                add("kura_request_failures_total", labels, r.failures)
+                add("kura_request_retries_total", labels, r.retries)
+                add("kura_tokens_total", f'{labels},type="prompt"', r.prompt_tokens)
+                add(
+                    "kura_tokens_total",
+                    f'{labels},type="completion"',
+                    r.completion_tokens,
+                )
+                for bucket, count in r.histogram().items():
+                    add(
+                        "kura_request_latency_seconds",
+                        f'{labels},le="{bucket}"',
+                        count,
+                        "_bucket",
+                    )
+                add("kura_request_latency_seconds", labels, r.latency_sum, "_sum")
+                add("kura_request_latency_seconds", labels, r.latency_count, "_count")
+            for name, c in s.caches.items():
+                labels = f'stage="{s.name}",cache="{name}"'
+                add("kura_cache_requests_total", f'{labels},result="hit"', c.hits)
+                add("kura_cache_requests_total", f'{labels},result="miss"', c.misses)
+            for name, value in s.counters.items():
+                add("kura_events_total", f'stage="{s.name}",event="{name}"', value)
+
+        lines = []
+        for family, (kind, samples) in families.items():
+            lines.append(f"# TYPE {family} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+_current_stage: ContextVar[Optional[tuple[MetricsRecorder, StageMetrics]]] = ContextVar(
+    "kura_current_stage", default=None
+)
+
+
+def record_request(
+    kind: str,
+    latency: float,
+    success: bool = True,
+    retries: int = 0,
+    prompt_tokens: int = 0,
+    completion_tokens: int = 0,
+) -> None:
+    current = _current_stage.get()
+    if current is None:
+        return
+
+    recorder, stage = current
+    metrics = stage.requests.setdefault(kind, RequestMetrics())
+    metrics.requests += 1
+    metrics.failures += 0 if success else 1
+    metrics.retries += retries
+    metrics.prompt_tokens += prompt_tokens
+    metrics.completion_tokens += completion_tokens
+    metrics.observe(latency)
+    for callback in recorder.callbacks:
+        callback.on_request(stage.name, kind, latency, success, retries)
+
+
+def record_cache(name: str, hits: int = 0, misses: int = 0) -> None:
+    current = _current_stage.get()
+    if current is None:
+        return
+    cache = current[1].caches.setdefault(name, CacheMetrics())
+    cache.hits += hits
+    cache.misses += misses
+
+
+def increment(name: str, value: int = 1) -> None:
+    current = _current_stage.get()
+    if current is None:
+        return
+    counters = current[1].counters
+    counters[name] = counters.get(name, 0) + value
+
+
+def token_usage(response: object) -> tuple[int, int]:
+    """Pull (prompt, completion) token counts out of an OpenAI, instructor or Gemini response if it has them"""
+    raw = getattr(response, "_raw_response", None) or response
+    usage = getattr(raw, "usage", None)
+    if usage is not None:
+        return (
+            getattr(usage, "prompt_tokens", 0) or 0,
+            getattr(usage, "completion_tokens", 0) or 0,
+        )
+    usage = getattr(raw, "usage_metadata", None)
+    if usage is not None:
+        return (
+            getattr(usage, "prompt_token_count", 0) or 0,
+            getattr(usage, "candidates_token_count", 0) or 0,
+        )
+    return 0, 0
@@ -0,0 +1,268 @@
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from kura import metrics
+
+R = TypeVar("R")
+
+
+def estimate_tokens(*texts: str) -> int:
+    """A rough token count ( ~4 characters per token ) that is good enough for budgeting requests"""
+    return sum(len(text) for text in texts) // 4 + 1
+
+
+def _error_chain(exc: BaseException):
+    seen = set()
+    current: Optional[BaseException] = exc
+    while current is not None and id(current) not in seen:
+        seen.add(id(current))
+        yield current
+        current = current.__cause__ or current.__context__
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    return any(
+        _status_code(e) == 429 or type(e).__name__ in ("RateLimitError", "ResourceExhausted")
+        for e in _error_chain(exc)
+    )
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    """Timeouts, dropped connections and server errors are worth retrying, bad requests are not"""
+    for e in _error_chain(exc):
+        status = _status_code(e)
+        if status is not None and status >= 500:
+            return True
+        if isinstance(e, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+            return True
+        if type(e).__name__ in ("APIConnectionError", "APITimeoutError"):
+            return True
+    return False
+
+
+def is_input_error(exc: BaseException) -> bool:
+    """The provider rejected what we sent ( eg. an input that's too long ), as opposed to who sent it or where"""
+    return any(
+        _status_code(e) in (400, 422)
+        or type(e).__name__ in ("BadRequestError", "UnprocessableEntityError")
+        for e in _error_chain(exc)
+    )
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """The number of seconds the provider asked us to wait, if it told us"""
+    for e in _error_chain(exc):
+        headers = getattr(getattr(e, "response", None), "headers", None)
+        if not headers:
+            continue
+        try:
+            if headers.get("retry-after-ms") is not None:
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after") is not None:
+                return float(headers["retry-after"])
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+class TokenBucket:
+    """
+    A token bucket which refills at `rate_per_minute`. Callers reserve capacity up front and are told how long to wait, so a request that exceeds the bucket simply waits for its share rather than blocking forever.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class AdaptiveRateLimiter:
+    """
+    Controls how fast we send requests to a provider.
+
+    - Requests per minute and tokens per minute are enforced with token buckets
+    - The number of requests in flight adapts with AIMD, we add roughly one slot per window of successful requests and halve the window when we get a 429 ( or latency goes above `latency_target` )
+    - A Retry-After header pauses every caller sharing the limiter, not just the one that was throttled
+    - Retries use exponential backoff with full jitter so callers don't retry in lockstep
+
+    Share a single instance between every model that calls the same provider so they all draw from the same quota.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 50,
+        min_concurrency: int = 1,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        latency_target: Optional[float] = None,
+        decrease_factor: float = 0.5,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.request_bucket = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.rate_limited = 0
+        self.retries = 0
+        self._condition: Optional[asyncio.Condition] = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # Created lazily so that the limiter can be constructed outside of an event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self, estimated_tokens: int = 0) -> None:
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.in_flight < max(self.min_concurrency, int(self.concurrency))
+            )
+            self.in_flight += 1
+
+        delay = max(0.0, self.paused_until - time.monotonic())
+        if self.request_bucket is not None:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket is not None and estimated_tokens:
+            delay = max(delay, self.token_bucket.reserve(estimated_tokens))
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                # We already hold a slot, a cancellation while we wait mustn't leak it
+                await self.release()
+                raise
+
+    async def release(self) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency: float) -> None:
+        if self.latency_target is not None and latency > self.latency_target:
+            self.decrease()
+        else:
+            self.concurrency = min(
+                self.max_concurrency, self.concurrency + 1 / max(self.concurrency, 1)
+            )
+
+    def on_rate_limited(self, wait: Optional[float]) -> None:
+        self.rate_limited += 1
+        self.decrease()
+        if wait is not None:
+            self.paused_until = max(self.paused_until, time.monotonic() + wait)
+
+    def decrease(self) -> None:
+        # A burst of 429s from the same window should only shrink us once
+        now = time.monotonic()
+        if now - self.last_decrease < 1.0:
+            return
+        self.last_decrease = now
+        self.concurrency = max(
+            self.min_concurrency, self.concurrency * self.decrease_factor
+        )
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def call(
+        self,
+        fn: Callable[..., Awaitable[R]],
+        *args: Any,
+        estimated_tokens: int = 0,
+        request_kind: str = "llm",
+        max_retries: Optional[int] = None,
+        **kwargs: Any,
+    ) -> R:
+        """Call `fn(*args, **kwargs)` within our limits, retrying rate limits and transient errors.
+
+        Each call is recorded against the active metrics stage under `request_kind` with its latency across all attempts. `max_retries` overrides the limiter's own for this call.
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        call_start = time.monotonic()
+        for attempt in range(max_retries + 1):
+            await self.acquire(estimated_tokens)
+            start = time.monotonic()
+            try:
+                # Cancellation is a BaseException so the slot is released here rather than in each branch below
+                try:
+                    result = await fn(*args, **kwargs)
+                finally:
+                    await self.release()
+            except Exception as e:
+                if attempt == max_retries:
+                    metrics.record_request(
+                        request_kind,
+                        time.monotonic() - call_start,
+                        success=False,
+                        retries=attempt,
+                    )
+                    raise
+
+                if is_rate_limit_error(e):
+                    wait = retry_after(e)
+                    self.on_rate_limited(wait)
+                    # Add a little jitter on top of Retry-After so everyone doesn't come back at the same instant
+                    delay = (
+                        wait + random.uniform(0, self.base_delay)
+                        if wait is not None
+                        else self.backoff(attempt)
+                    )
+                elif is_transient_error(e):
+                    delay = self.backoff(attempt)
+                else:
+                    metrics.record_request(
+                        request_kind,
+                        time.monotonic() - call_start,
+                        success=False,
+                        retries=attempt,
+                    )
+                    raise
+
+                self.retries += 1
+                await asyncio.sleep(delay)
+                continue
+
+            self.on_success(time.monotonic() - start)
+            prompt_tokens, completion_tokens = metrics.token_usage(result)
+            metrics.record_request(
+                request_kind,
+                time.monotonic() - call_start,
+                retries=attempt,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+            )
+            return result
+
+        raise RuntimeError("unreachable")
@@ -2,63 +2,73 @@ from kura.base_classes import BaseSummaryModel
 from kura.types import Conversation, ConversationSummary
 from kura.types.summarisation import GeneratedSummary
 from asyncio import Semaphore
-from tqdm.asyncio import tqdm_asyncio
-# import google.generativeai as genai
-import instructor
-import vertexai
-import os
-from dotenv import load_dotenv, find_dotenv
-from openai import AsyncOpenAI
-import asyncio
+from kura.clients import create_completion, get_instructor_openai_client
+from kura.concurrency import bounded_map
+from kura import metrics
+from kura.rate_limit import AdaptiveRateLimiter
+from kura.truncation import ConversationTruncator, TruncationResult
+from tqdm.auto import tqdm
+from typing import AsyncIterable, AsyncIterator, Iterable, Optional, Sized, Union
 
 
-load_dotenv(find_dotenv())
-vertexai.init()
-
 class SummaryModel(BaseSummaryModel):
     def __init__(
         self,
         max_concurrent_requests: int = 50,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        client=None,
+        truncator: Optional[ConversationTruncator] = None,
     ):
+        self.max_concurrent_requests = max_concurrent_requests
         self.sem = Semaphore(max_concurrent_requests)
-        # self.client = instructor.from_gemini(
-        #     genai.GenerativeModel(
-        #         model_name="gemini-1.5-flash-latest",
-        #     ),
-        #     use_async=True,
-        # )
-
-        self.client = instructor.from_openai(
-            AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"], base_url=os.environ["OPENAI_API_BASE"]),
-            # use_async=True,
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter(
+            max_concurrency=max_concurrent_requests
         )
-
-
-#        self.client = instructor.from_vertexai(
-#            vertexai.generative_models.GenerativeModel("gemini-1.5-flash-001"), 
-#            _async=True,
-#            mode=instructor.Mode.VERTEXAI_TOOLS
-#        )
-        
+        # Defaults to the shared instructor client for OpenAI, which is only created on the first request. To use Gemini instead pass in
+        #
+        # instructor.from_gemini(genai.GenerativeModel(model_name="gemini-1.5-flash-latest"), use_async=True)
+        #
+        # or for Vertex AI ( remember to call vertexai.init() first )
+        #
+        # instructor.from_vertexai(vertexai.generative_models.GenerativeModel("gemini-1.5-flash-001"), _async=True, mode=instructor.Mode.VERTEXAI_TOOLS)
+        self._client = client
+        # Long conversations are cut down to a token budget before they're rendered into the prompt, pass ConversationTruncator(max_tokens=None) to send them unchanged
+        self.truncator = truncator or ConversationTruncator()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_instructor_openai_client()
+        return self._client
 
     async def summarise(
         self, conversations: list[Conversation]
     ) -> list[ConversationSummary]:
-
-        summaries = []
-        batch_size = 100  # Adjust the batch size as needed
-        for i in range(0, len(conversations), batch_size):
-            batch = conversations[i:i + batch_size]
-            batch_summaries = await tqdm_asyncio.gather(
-                *[
-                    self.summarise_conversation(conversation)
-                    for conversation in batch
-                ],
-                desc=f"Summarising batch {i // batch_size + 1} of {len(conversations) // batch_size + 1}",
-            )
-            summaries.extend(batch_summaries)
-            # await asyncio.sleep(1)  # Add a sleep to avoid hitting the rate limit
-        return summaries
+        # Summaries come back in the order they complete so we restore the order of the conversations
+        position = {
+            conversation.chat_id: i for i, conversation in enumerate(conversations)
+        }
+        summaries = [summary async for summary in self.summarise_stream(conversations)]
+        return sorted(summaries, key=lambda summary: position[summary.chat_id])
+
+    async def summarise_stream(
+        self,
+        conversations: Union[Iterable[Conversation], AsyncIterable[Conversation]],
+    ) -> AsyncIterator[ConversationSummary]:
+        """
+        Summarise conversations with a sliding window of `max_concurrent_requests` calls in flight, yielding each summary as soon as it completes.
+        """
+        with tqdm(
+            total=len(conversations) if isinstance(conversations, Sized) else None,
+            desc="Summarising Conversations",
+        ) as pbar:
+            async for summary in bounded_map(
+                self.summarise_conversation,
+                conversations,
+                self.max_concurrent_requests,
+            ):
+                pbar.update(1)
+                yield summary
 
     async def apply_hooks(
         self, conversation: ConversationSummary
@@ -69,15 +79,23 @@ class SummaryModel(BaseSummaryModel):
     async def summarise_conversation(
         self, conversation: Conversation
     ) -> ConversationSummary:
-        resp = await self.client.chat.completions.create(
-            # model = "gemini-1.5-flash-001",
-            model = "gpt-4o-eastus",
-            # model = "gpt-4o-mini-eastus",
-
-            messages=[
-                {
-                    "role": "user",
-                    "content": """
+        truncated = self.truncator.truncate(conversation)
+        if truncated.saved_tokens:
+            metrics.increment("truncated_conversations")
+            metrics.increment("truncated_tokens", truncated.saved_tokens)
+
+        async with self.sem:
+            resp = await create_completion(
+                self.client,
+                self.rate_limiter,
+                # model = "gemini-1.5-flash-001",
+                model = "gpt-4o-eastus",
+                # model = "gpt-4o-mini-eastus",
+
+                messages=[
+                    {
+                        "role": "user",
+                        "content": """
                     Generate a summary of the task that the user is asking the language model to do based off the following conversation.
 
 
@@ -104,15 +122,26 @@ class SummaryModel(BaseSummaryModel):
                     - Make sure to omit any personally identifiable information (PII), like names, locations, phone numbers, email addressess, company names and so on.
                     - Make sure to indicate specific details such as programming languages, frameworks, libraries and so on which are relevant to the task.
                     """,
-                }
-            ],
-            context={"messages": conversation.messages},
-            response_model=GeneratedSummary,
-        )
+                    }
+                ],
+                context={"messages": truncated.conversation.messages},
+                response_model=GeneratedSummary,
+                estimated_tokens=truncated.tokens + 500,
+            )
         return ConversationSummary(
             chat_id=conversation.chat_id,
             summary=resp.summary,
-            metadata={
-                "conversation_turns": len(conversation.messages),
-            },
+            metadata=self.conversation_metadata(conversation, truncated),
         )
+
+    def conversation_metadata(
+        self, conversation: Conversation, truncated: Optional[TruncationResult] = None
+    ) -> dict:
+        if truncated is None:
+            truncated = self.truncator.truncate(conversation)
+        return {
+            "conversation_turns": len(conversation.messages),
+            "conversation_tokens": truncated.original_tokens,
+            "prompt_tokens": truncated.tokens,
+            "truncated_tokens": truncated.saved_tokens,
+        }
@@ -0,0 +1,292 @@
+"""
+Deterministic, offline stand-ins for the embedding model and the instructor client.
+
+These let us run ( and benchmark ) the full pipeline without any API keys. Responses are derived from a hash of the inputs so the same inputs always give the same outputs, while latency and failures are drawn from a seeded random number generator so that they're reproducible too.
+"""
+
+import asyncio
+import hashlib
+import math
+import random
+import re
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from kura.base_classes import BaseEmbeddingModel
+from kura.meta_cluster import CandidateClusters, ClusterLabel, ClusterLabels
+from kura.types import Conversation, GeneratedCluster, GeneratedSummary, Message
+
+
+class FakeRateLimitError(Exception):
+    """Raised to simulate a provider returning a 429, the rate limiter treats it like the real thing"""
+
+    status_code = 429
+
+
+class LatencySimulator:
+    def __init__(
+        self,
+        latency_mean: float = 0.0,
+        latency_sigma: float = 0.5,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        """
+        Latencies follow a log-normal distribution with mean `latency_mean` seconds, `latency_sigma` controls how heavy the tail is. `error_rate` is the fraction of requests that fail with a `FakeRateLimitError`.
+        """
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+
+    async def __call__(self) -> None:
+        self.requests += 1
+        if self.latency_mean > 0:
+            mu = math.log(self.latency_mean) - self.latency_sigma**2 / 2
+            await asyncio.sleep(self.rng.lognormvariate(mu, self.latency_sigma))
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            raise FakeRateLimitError("Simulated rate limit")
+
+
+def _seed(text: str) -> int:
+    return int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+
+
+def _words(text: str) -> list[str]:
+    return re.findall(r"[a-z]+", text.lower())
+
+
+class FakeEmbeddingModel(BaseEmbeddingModel):
+    """
+    Embeds a text as the normalised sum of a fixed random vector per word, so texts that share words end up close together and clustering behaves sensibly.
+    """
+
+    def __init__(
+        self,
+        dim: int = 64,
+        batch_size: int = 2048,
+        latency: Optional[LatencySimulator] = None,
+    ):
+        self.model_name = f"fake-embedding-{dim}"
+        self.dim = dim
+        self.batch_size = batch_size
+        self.latency = latency or LatencySimulator()
+        self.word_vectors: dict[str, np.ndarray] = {}
+
+    def vector(self, text: str) -> list[float]:
+        words = _words(text) or [text]
+        for word in words:
+            if word not in self.word_vectors:
+                self.word_vectors[word] = (
+                    np.random.default_rng(_seed(word))
+                    .standard_normal(self.dim)
+                    .astype(np.float32)
+                )
+        total = np.sum([self.word_vectors[word] for word in words], axis=0)
+        return (total / max(float(np.linalg.norm(total)), 1e-12)).tolist()
+
+    async def embed(self, text: str, sem: asyncio.Semaphore) -> list[float]:
+        async with sem:
+            await self.latency()
+            return self.vector(text)
+
+    async def embed_batch(
+        self, texts: list[str], sem: asyncio.Semaphore, desc: Optional[str] = None
+    ) -> list[list[float]]:
+        async def embed_request(batch: list[str]) -> list[list[float]]:
+            async with sem:
+                await self.latency()
+                return [self.vector(text) for text in batch]
+
+        results = await asyncio.gather(
+            *[
+                embed_request(texts[i : i + self.batch_size])
+                for i in range(0, len(texts), self.batch_size)
+            ]
+        )
+        return [embedding for batch in results for embedding in batch]
+
+
+def _top_words(texts: list[str], count: int) -> list[str]:
+    counts = Counter(word for text in texts for word in _words(text) if len(word) > 3)
+    return [word for word, _ in counts.most_common(count)] or ["general"]
+
+
+class _FakeCompletions:
+    def __init__(self, client: "FakeInstructorClient"):
+        self.client = client
+
+    async def create(
+        self,
+        response_model: type[BaseModel],
+        messages: Optional[list[dict]] = None,
+        context: Optional[dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> BaseModel:
+        await self.client.latency()
+        context = context or {}
+        return response_model.model_validate(
+            self.client.respond(response_model, context), context=context
+        )
+
+
+class _FakeChat:
+    def __init__(self, client: "FakeInstructorClient"):
+        self.completions = _FakeCompletions(client)
+
+
+class FakeInstructorClient:
+    """
+    Mimics `client.chat.completions.create(...)` of an async instructor client for the response models used by `SummaryModel`, `ClusterModel` and `MetaClusterModel`.
+    """
+
+    def __init__(self, latency: Optional[LatencySimulator] = None):
+        self.latency = latency or LatencySimulator()
+        self.chat = _FakeChat(self)
+
+    def best_candidate(self, cluster: Any, candidates: list[str]) -> str:
+        words = set(_words(cluster.name))
+        return max(
+            candidates,
+            key=lambda candidate: (
+                len(words & set(_words(candidate))),
+                -_seed(cluster.id + candidate) % 997,
+            ),
+        )
+
+    def respond(self, response_model: type[BaseModel], context: dict[str, Any]) -> dict:
+        if issubclass(response_model, GeneratedSummary):
+            messages = context["messages"]
+            request = " ".join(_words(messages[0].content)[:30]) if messages else ""
+            return {
+                "summary": f"The user's overall request for the assistant is to {request}"
+            }
+
+        if issubclass(response_model, GeneratedCluster):
+            texts = [item.summary for item in context.get("positive_examples", [])] or [
+                f"{c.name} {c.description}" for c in context.get("clusters", [])
+            ]
+            words = _top_words(texts, 4)
+            return {
+                "name": f"Help with {' '.join(words)}",
+                "summary": f"Users asked for help with {', '.join(words)}. These requests shared a common theme.",
+            }
+
+        if issubclass(response_model, CandidateClusters):
+            clusters = context["clusters"]
+            count = max(1, math.ceil(context["desired_number"] / 2))
+            names = []
+            for i in range(count):
+                group = clusters[i::count]
+                names.append(
+                    f"Assist with {' '.join(_top_words([c.name for c in group], 3))} {i}"
+                )
+            return {"candidate_cluster_names": names}
+
+        if issubclass(response_model, ClusterLabel):
+            return {
+                "higher_level_cluster": self.best_candidate(
+                    context["cluster"], context["candidate_clusters"]
+                )
+            }
+
+        if issubclass(response_model, ClusterLabels):
+            return {
+                "assignments": [
+                    {
+                        "cluster_id": i + 1,
+                        "higher_level_cluster": self.best_candidate(
+                            cluster, context["candidate_clusters"]
+                        ),
+                    }
+                    for i, cluster in enumerate(context["clusters"])
+                ]
+            }
+
+        raise NotImplementedError(
+            f"FakeInstructorClient doesn't know how to respond with {response_model.__name__}"
+        )
+
+
+TOPICS = [
+    "debug a memory leak in a python data pipeline",
+    "write a react component that renders a paginated table",
+    "design a rest api for a social media application",
+    "plan a birthday party for a group of friends",
+    "draft a cover letter for a software engineering job",
+    "explain the difference between tcp and udp networking",
+    "optimise a slow postgres query with joins",
+    "translate a marketing email into spanish",
+    "summarise a research paper about protein folding",
+    "create a weekly meal plan for a vegetarian diet",
+    "fix a failing github actions workflow",
+    "write unit tests for a typescript utility module",
+]
+
+
+QUALIFIERS = [
+    "for a small startup",
+    "using rust",
+    "using golang",
+    "for a school project",
+    "on a raspberry pi",
+    "with strict latency requirements",
+    "for a nonprofit charity",
+    "in a legacy codebase",
+    "for mobile users",
+    "with limited budget",
+    "before a tight deadline",
+    "for an enterprise customer",
+    "in a kubernetes cluster",
+    "for elderly relatives",
+    "with accessibility in mind",
+]
+
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "pa"]
+
+
+def generate_conversations(
+    n: int,
+    seed: int = 0,
+    min_turns: int = 1,
+    max_turns: int = 4,
+    start: datetime = datetime(2024, 1, 1),
+    days: int = 90,
+) -> list[Conversation]:
+    """Generate `n` synthetic conversations spread over `days` days, each about one of a fixed set of topics"""
+    rng = random.Random(seed)
+    conversations = []
+    for i in range(n):
+        topic = f"{rng.choice(TOPICS)} {rng.choice(QUALIFIERS)}"
+        created_at = start + timedelta(seconds=rng.randrange(days * 24 * 60 * 60))
+        messages = []
+        for turn in range(rng.randint(min_turns, max_turns)):
+            timestamp = created_at + timedelta(minutes=2 * turn)
+            # A made-up project name so that conversations about the same topic aren't identical
+            detail = "".join(rng.choice(SYLLABLES) for _ in range(3))
+            messages.append(
+                Message(
+                    created_at=timestamp,
+                    role="user",
+                    content=f"Can you help me {topic}? This is for project {detail}.",
+                )
+            )
+            messages.append(
+                Message(
+                    created_at=timestamp + timedelta(minutes=1),
+                    role="assistant",
+                    content=f"Sure, here is how to {topic} for project {detail}.",
+                )
+            )
+        conversations.append(
+            Conversation(chat_id=f"chat-{i}", created_at=created_at, messages=messages)
+        )
+    return conversations
@@ -0,0 +1,171 @@
+"""
+Fit long conversations into a token budget before they're summarised.
+
+We always keep the first user message since it usually states what the user wanted, then fill the rest of the budget with the most recent messages. Messages that are longer than `max_message_tokens` are cut down in the middle so both their start and their end survive.
+
+Tokens are counted with tiktoken when it's installed ( `pip install kura[tokenizer]` ) and its encoding can be loaded, otherwise we fall back to the same ~4 characters per token estimate that the rate limiter uses.
+"""
+
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from typing import TYPE_CHECKING, Optional
+
+from pydantic import BaseModel
+
+from kura.rate_limit import estimate_tokens
+from kura.types import Conversation, Message
+
+if TYPE_CHECKING:
+    import tiktoken
+
+# Tokens for the role and the tags that wrap each message in the prompt
+MESSAGE_OVERHEAD = 8
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(encoding: str = "o200k_base") -> Optional["tiktoken.Encoding"]:
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.get_encoding(encoding)
+    except Exception as e:
+        # tiktoken downloads encodings on first use so this fails when we're offline, an estimate is better than failing the whole run
+        print(
+            f"Couldn't load the {encoding} encoding ({type(e).__name__}: {e}), estimating token counts instead"
+        )
+        return None
+
+
+# Counts are keyed on a digest of the text rather than the text itself so that the cache doesn't keep whole transcripts alive
+_token_counts: OrderedDict[tuple[bytes, str], int] = OrderedDict()
+_token_counts_lock = Lock()
+TOKEN_COUNT_CACHE_SIZE = 65_536
+
+
+def count_tokens(text: str, encoding: str = "o200k_base") -> int:
+    # The same messages turn up again and again ( eg. system prompts pasted into every chat ) so counts are cached too
+    key = (hashlib.blake2b(text.encode(), digest_size=16).digest(), encoding)
+    with _token_counts_lock:
+        if key in _token_counts:
+            _token_counts.move_to_end(key)
+            return _token_counts[key]
+
+    tokenizer = get_tokenizer(encoding)
+    if tokenizer is None:
+        count = estimate_tokens(text)
+    else:
+        count = len(tokenizer.encode(text, disallowed_special=()))
+
+    with _token_counts_lock:
+        _token_counts[key] = count
+        while len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return count
+
+
+def truncate_text(text: str, max_tokens: int, encoding: str = "o200k_base") -> str:
+    """Cut `text` down to roughly `max_tokens` by dropping its middle"""
+    tokens = count_tokens(text, encoding)
+    if tokens <= max_tokens:
+        return text
+
+    head = max_tokens // 2
+    tail = max_tokens - head
+    marker = f"\n[... {tokens - max_tokens} tokens truncated ...]\n"
+
+    tokenizer = get_tokenizer(encoding)
+    if tokenizer is None:
+        head_chars, tail_chars = head * CHARS_PER_TOKEN, tail * CHARS_PER_TOKEN
+        return text[:head_chars] + marker + (text[-tail_chars:] if tail_chars else "")
+
+    encoded = tokenizer.encode(text, disallowed_special=())
+    return (
+        tokenizer.decode(encoded[:head])
+        + marker
+        + (tokenizer.decode(encoded[-tail:]) if tail else "")
+    )
+
+
+class TruncationResult(BaseModel):
+    conversation: Conversation
+    original_tokens: int
+    tokens: int
+    omitted_messages: int = 0
+    truncated_messages: int = 0
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.original_tokens - self.tokens
+
+
+class ConversationTruncator:
+    def __init__(
+        self,
+        max_tokens: Optional[int] = 16_000,
+        max_message_tokens: int = 4_000,
+        encoding: str = "o200k_base",
+    ):
+        """
+        `max_tokens` is the budget for all of a conversation's messages, set it to None to send conversations unchanged.
+        """
+        self.max_tokens = max_tokens
+        self.max_message_tokens = max_message_tokens
+        self.encoding = encoding
+
+    def message_tokens(self, message: Message) -> int:
+        return count_tokens(message.content, self.encoding) + MESSAGE_OVERHEAD
+
+    def shorten(self, message: Message, max_tokens: int) -> Message:
+        content = truncate_text(
+            message.content, max(max_tokens - MESSAGE_OVERHEAD, 0), self.encoding
+        )
+        if content == message.content:
+            return message
+        return message.model_copy(update={"content": content})
+
+    def truncate(self, conversation: Conversation) -> TruncationResult:
+        messages = conversation.messages
+        counts = [self.message_tokens(message) for message in messages]
+        original_tokens = sum(counts)
+        if self.max_tokens is None or original_tokens <= self.max_tokens:
+            return TruncationResult(
+                conversation=conversation,
+                original_tokens=original_tokens,
+                tokens=original_tokens,
+            )
+
+        per_message = min(self.max_message_tokens, self.max_tokens)
+        shortened = [
+            self.shorten(message, per_message) if count > per_message else message
+            for message, count in zip(messages, counts)
+        ]
+
+        # The first user message is always kept, then we walk back from the end of the conversation until the budget runs out
+        first = next(
+            (i for i, message in enumerate(shortened) if message.role == "user"), 0
+        )
+        kept = {first: shortened[first]}
+        budget = self.max_tokens - self.message_tokens(shortened[first])
+        for i in range(len(shortened) - 1, first, -1):
+            tokens = self.message_tokens(shortened[i])
+            if tokens > budget:
+                # Rather than dropping the most recent message we shorten it to whatever room is left
+                if len(kept) == 1 and budget > MESSAGE_OVERHEAD:
+                    kept[i] = self.shorten(shortened[i], budget)
+                break
+            kept[i] = shortened[i]
+            budget -= tokens
+
+        kept_messages = [kept[i] for i in sorted(kept)]
+        return TruncationResult(
+            conversation=conversation.model_copy(update={"messages": kept_messages}),
+            original_tokens=original_tokens,
+            tokens=sum(self.message_tokens(message) for message in kept_messages),
+            omitted_messages=len(messages) - len(kept_messages),
+            truncated_messages=sum(kept[i] is not messages[i] for i in kept),
+        )
@@ -1,6 +1,6 @@
 from .conversation import Conversation, Message
 from .summarisation import ConversationSummary, GeneratedSummary
-from .cluster import Cluster, GeneratedCluster
+from .cluster import Cluster, GeneratedCluster, IncrementalClusterUpdate
 from .dimensionality import ProjectedCluster
 
 __all__ = [
@@ -10,5 +10,6 @@ __all__ = [
     "ConversationSummary",
     "GeneratedSummary",
     "GeneratedCluster",
+    "IncrementalClusterUpdate",
     "ProjectedCluster",
 ]
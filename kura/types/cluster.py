@@ -20,3 +20,9 @@ class Cluster(BaseModel):
 class GeneratedCluster(BaseModel):
     name: str
     summary: str
+
+
+class IncrementalClusterUpdate(BaseModel):
+    clusters: list[Cluster]
+    assignments: dict[str, str]
+    drifted_cluster_ids: list[str]
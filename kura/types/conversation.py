@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Literal
+from typing import Iterator, Literal, TextIO
 import json
 
 
@@ -10,44 +10,114 @@ class Message(BaseModel):
     content: str
 
 
+def parse_timestamp(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def iter_json_array(f: TextIO, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """
+    Yield the items of a top level JSON array one at a time, only keeping the item that is currently being parsed in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        # Skip over whitespace, the opening bracket and the separators between items
+        while pos < len(buffer):
+            char = buffer[pos]
+            if char.isspace() or (started and char == ","):
+                pos += 1
+            elif not started and char == "[":
+                started = True
+                pos += 1
+            else:
+                break
+
+        if pos < len(buffer):
+            if not started:
+                raise ValueError("Expected the file to contain a JSON array")
+            if buffer[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # A number may continue in the next chunk ( eg. "12" of "12,", or "6.5" of "6.5e3" ) so we only trust one that is followed by a separator
+                complete = end < len(buffer) and (
+                    not isinstance(item, (int, float))
+                    or buffer[end].isspace()
+                    or buffer[end] in ",]"
+                )
+                if complete or eof:
+                    yield item
+                    pos = end
+                    continue
+
+        if eof:
+            raise ValueError("Unexpected end of file while reading JSON array")
+
+        # Drop everything we've consumed and read more, growing the read for items larger than a single chunk so that they aren't re-parsed too many times
+        buffer = buffer[pos:]
+        pos = 0
+        chunk = f.read(max(chunk_size, len(buffer)))
+        eof = not chunk
+        buffer += chunk
+
+
 class Conversation(BaseModel):
     chat_id: str
     created_at: datetime
     messages: list[Message]
 
     @classmethod
-    def from_claude_conversation_dump(cls, file_path: str) -> list["Conversation"]:
-        with open(file_path, "r") as f:
-            return [
-                Conversation(
-                    chat_id=conversation["uuid"],
-                    created_at=conversation["created_at"],
-                    messages=[
-                        Message(
-                            created_at=datetime.fromisoformat(
-                                message["created_at"].replace("Z", "+00:00")
-                            ),
-                            role="user"
-                            if message["sender"] == "human"
-                            else "assistant",
-                            content="\n".join(
-                                [
-                                    item["text"]
-                                    for item in message["content"]
-                                    if item["type"] == "text"
-                                ]
-                            ),
-                        )
-                        for message in sorted(
-                            conversation["chat_messages"],
-                            key=lambda x: (
-                                datetime.fromisoformat(
-                                    x["created_at"].replace("Z", "+00:00")
-                                ),
-                                0 if x["sender"] == "human" else 1,
-                            ),
-                        )
-                    ],
+    def from_claude_conversation(cls, conversation: dict) -> "Conversation":
+        # We parse each timestamp once and sort on the parsed value
+        messages = sorted(
+            (
+                (
+                    parse_timestamp(message["created_at"]),
+                    0 if message["sender"] == "human" else 1,
+                    message,
                 )
-                for conversation in json.load(f)
-            ]
+                for message in conversation["chat_messages"]
+            ),
+            key=lambda x: (x[0], x[1]),
+        )
+        return cls(
+            chat_id=conversation["uuid"],
+            created_at=conversation["created_at"],
+            messages=[
+                Message(
+                    created_at=created_at,
+                    role="user" if sender == 0 else "assistant",
+                    content="\n".join(
+                        [
+                            item["text"]
+                            for item in message["content"]
+                            if item["type"] == "text"
+                        ]
+                    ),
+                )
+                for created_at, sender, message in messages
+            ],
+        )
+
+    @classmethod
+    def iter_claude_conversation_dump(
+        cls, file_path: str, chunk_size: int = 1 << 20
+    ) -> Iterator["Conversation"]:
+        """
+        Lazily yield the conversations in a Claude export so that large exports can be processed without loading the whole file into memory.
+        """
+        with open(file_path, "r", encoding="utf-8") as f:
+            for conversation in iter_json_array(f, chunk_size):
+                yield cls.from_claude_conversation(conversation)
+
+    @classmethod
+    def from_claude_conversation_dump(cls, file_path: str) -> list["Conversation"]:
+        return list(cls.iter_claude_conversation_dump(file_path))
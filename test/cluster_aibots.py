@@ -7,7 +7,6 @@ import os
 
 from pathlib import Path
 from uuid import uuid4
-from datetime import datetime
 from asyncio import run
 
 
@@ -16,7 +15,7 @@ from kura.cluster import ClusterModel
 from kura.embedding import OpenAIEmbeddingModel
 from kura.summarisation import SummaryModel
 from kura.dimensionality import HDBUMAP
-from kura.types import Conversation, Message
+from kura.loaders import ColumnMapping, load_conversations
 
 # vertexai.init()
 
@@ -33,56 +32,18 @@ def load_conversation_data(file_path, sample_size=None):
     Returns:
         List of Kura Conversation objects
     """
-    # Load the CSV data
-    df = pd.read_csv(file_path)
-    
-    # Group by conversation ID
-    grouped = df.groupby("conversationId")
-    
-    all_conversations = []
-    count = 0
-    
-    # Process each conversation group
-    for convo_id, group in grouped:
-        messages = []
-        
-        # Process each message in the conversation
-        for _, row in group.iterrows():
-            # Create and add user message
-            user_message = Message(
-                created_at=row["queryDatetime"],
-                role="user",
-                content=row["query"],
-                id=row["_id"],
-            )
-            
-            # Create and add assistant message
-            assistant_message = Message(
-                created_at=row["queryDatetime"],
-                role="assistant",
-                content=row["response"],
-                id=row["_id"],
-            )
-            
-            messages.append(user_message)
-            messages.append(assistant_message)
-        
-        # Create a Conversation object for this group
-        current_convo = Conversation(
-            messages=messages,
-            chat_id=convo_id,
-            created_at=datetime.now(),
-        )
-        
-        all_conversations.append(current_convo)
-        count += 1
-        
-        # Stop after reaching the sample size
-        if sample_size is not None:
-            if count >= sample_size:
-                break
-            
-    return all_conversations
+    # Each row holds a single query and its response, rows for a conversation aren't next to each other in the export
+    return load_conversations(
+        file_path,
+        ColumnMapping(
+            chat_id="conversationId",
+            created_at="queryDatetime",
+            user_content="query",
+            assistant_content="response",
+        ),
+        assume_sorted=False,
+        max_conversations=sample_size,
+    )
 
 
 def initialize_kura_engine(output_dir, max_clusters):
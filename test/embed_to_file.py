@@ -1,4 +1,5 @@
 from kura.embedding import OpenAIEmbeddingModel
+from kura.embedding_store import EmbeddingStore
 import json
 import asyncio
 import tqdm
@@ -6,33 +7,25 @@ from asyncio import Semaphore
 
 def main():
     embedding_model = OpenAIEmbeddingModel()
-    
-    async def process_batch(batch, batch_num, total_batches):
-        results = []
-        # Adding tqdm progress bar for each item within the batch
-        for data in tqdm.tqdm(batch, desc=f"Batch {batch_num}/{total_batches}", leave=False):
-            embeddings = await embedding_model.embed(data["summary"], Semaphore(10))
-            results.append({**data, "embeddings": embeddings})
-        return results
+    store = EmbeddingStore("../data/aibots_conversations/embeddings")
     
     async def main_async():
         # Read all lines into memory
         with open("../data/aibots_conversations/summaries/summaries.jsonl", "r") as f:
             lines = [json.loads(line) for line in f]
+
+        # Skip anything that we've already embedded so that the script can be re-run after a failure
+        lines = [data for data in lines if data["chat_id"] not in store]
+        sem = Semaphore(10)
         
-        # Process in batches of 100
-        batches = [lines[i:i+100] for i in range(0, len(lines), 100)][168:]
-        total_batches = len(batches)
+        # Process in batches of 1000, each batch is written to the store as soon as it completes
+        batches = [lines[i:i+1000] for i in range(0, len(lines), 1000)]
         
-        for batch_num, batch in enumerate(tqdm.tqdm(batches, desc="Processing batches"), 1):
-            batch_results = await process_batch(batch, batch_num, total_batches)
-            # Write results for this batch immediately
-            for item in batch_results:
-                chat_id = item["chat_id"]
-                with open(f"../data/aibots_conversations/embeddings/{chat_id}.json", "w") as f:
-                    f.write(json.dumps(item) + "\n")
-                    # Flush to ensure data is written to disk
-                    f.flush()
+        for batch in tqdm.tqdm(batches, desc="Processing batches"):
+            embeddings = await embedding_model.embed_batch(
+                [data["summary"] for data in batch], sem
+            )
+            store.append([data["chat_id"] for data in batch], embeddings)
     
     asyncio.run(main_async())
 